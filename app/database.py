@@ -1,460 +1,637 @@
 import sqlite3
-import json
-from datetime import datetime
+import csv
+import io
 import os
+import threading
+import queue
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from core.file_utils import format_receipt_filename
 
+def _remove_file(file_path):
+    """Delete a file, returning 1 if it was removed and 0 otherwise"""
+    try:
+        Path(file_path).unlink()
+        return 1
+    except FileNotFoundError:
+        return 0
+    except Exception as e:
+        print(f"Error deleting file {file_path}: {e}")
+        return 0
+
 class ExpenseDatabase:
+    # Statements shared by several methods. Keeping the text identical lets
+    # sqlite3's statement cache reuse the prepared statement.
+    _SELECT_RECEIPTS_SQL = '''
+        SELECT id, filename, file_path, ocr_text, restaurant_name, date, total_amount, reviewed,
+               cuenta_contable, pais, cc, fx_rate, markup_percent, amount_mxn, reembolso, detalle, display_filename
+        FROM receipts
+    '''
+    _SELECT_ALL_RECEIPTS_SQL = _SELECT_RECEIPTS_SQL + 'ORDER BY created_at DESC'
+    _SELECT_RECEIPT_SQL = _SELECT_RECEIPTS_SQL + 'WHERE id = ?'
+    # Reports and exports never look at the OCR text, the bulk of each row
+    _EXPORT_RECEIPTS_SQL = '''
+        SELECT id, filename, file_path, restaurant_name, date, total_amount, reviewed,
+               cuenta_contable, pais, cc, fx_rate, markup_percent, amount_mxn, reembolso, detalle, display_filename
+        FROM receipts
+        WHERE reviewed = TRUE
+    '''
+    _SELECT_EXPORT_RECEIPTS_SQL = _EXPORT_RECEIPTS_SQL + 'ORDER BY created_at DESC'
+    _SELECT_EXPORT_RECEIPTS_BY_NAME_SQL = (_EXPORT_RECEIPTS_SQL +
+                                           'ORDER BY LOWER(COALESCE(display_filename, filename)), created_at DESC')
+    # amount_mxn holds the USD amount: MXN total / FX rate plus the markup
+    _INSERT_RECEIPT_SQL = '''
+        INSERT INTO receipts (filename, file_path, ocr_text, restaurant_name, date, total_amount, 
+                            fx_rate, markup_percent, amount_mxn, content_hash)
+        VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8,
+                CASE WHEN ?6 > 0 THEN ?6 / ?7 * (1 + ?8 / 100.0) END, ?9)
+    '''
+    _UPDATE_RECEIPT_SQL = '''
+        UPDATE receipts
+        SET restaurant_name = ?, date = ?, total_amount = ?, cuenta_contable = ?,
+            cc = ?, fx_rate = ?, markup_percent = ?, amount_mxn = ?, reembolso = ?, detalle = ?,
+            display_filename = ?, reviewed = TRUE, updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+        WHERE id = ?
+    '''
+
+    # Categories are only ever looked up by type and value
+    _CREATE_CATEGORIES_SQL = '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            category_type TEXT NOT NULL,
+            category_value TEXT NOT NULL,
+            usage_count INTEGER DEFAULT 1,
+            last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (category_type, category_value)
+        ) WITHOUT ROWID
+    '''
+    
+    # Number of read-only connections kept open for concurrent reads
+    _READ_POOL_SIZE = 4
+    
     def __init__(self, db_path="expenses.db"):
         self.db_path = db_path
+        # One long-lived write connection shared by all threads, so its page
+        # cache stays warm between calls. The lock serializes access to it.
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.RLock()
+        # Reads go through a small pool of query-only connections instead, so
+        # with WAL they run alongside each other and alongside a writer
+        self._read_pool = None
+        self._read_pool_pid = None
+        self._read_pool_lock = threading.Lock()
+        # Settings are cached and re-read from a reader when they may have changed
+        self._settings = {}
+        self._settings_versions = {}
         self.init_database()
     
+    def _connect(self):
+        """Open a new connection configured for concurrent use"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # WAL lets readers keep working while another thread writes, and with
+        # synchronous=NORMAL a commit is an append rather than an fsync
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        # These only last for the connection, so they are set on every open
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-64000')
+        conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+    
+    def _get_connection(self):
+        """Get the shared connection, opening it on first use (call with the lock held)"""
+        # A connection inherited from a parent process (e.g. gunicorn --preload)
+        # must not be used after the fork, so open a fresh one in the worker
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = self._connect()
+            # Rows can be turned into dicts by column name without index bookkeeping
+            self._conn.row_factory = sqlite3.Row
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    def _connect_reader(self):
+        """Open a connection for the read pool"""
+        conn = self._connect()
+        conn.execute('PRAGMA query_only=1')
+        conn.execute('PRAGMA cache_size=-16000')
+        conn.row_factory = sqlite3.Row
+        return conn
+    
+    @contextmanager
+    def _read(self):
+        """Borrow a read-only connection from the pool for the duration of a block"""
+        # Like the write connection, the pool is reopened after a fork
+        if self._read_pool is None or self._read_pool_pid != os.getpid():
+            with self._read_pool_lock:
+                if self._read_pool is None or self._read_pool_pid != os.getpid():
+                    pool = queue.Queue()
+                    for _ in range(self._READ_POOL_SIZE):
+                        pool.put(self._connect_reader())
+                    # Settings cached against earlier connections must be re-read
+                    self._settings_versions = {}
+                    self._read_pool = pool
+                    self._read_pool_pid = os.getpid()
+        pool = self._read_pool
+        conn = pool.get()
+        try:
+            yield conn
+        finally:
+            pool.put(conn)
+    
+    @contextmanager
+    def _tx(self):
+        """Run a block as one transaction on the shared connection, yielding a cursor"""
+        # The connection's context manager commits on success and rolls back on error
+        with self._lock:
+            conn = self._get_connection()
+            with conn:
+                yield conn.cursor()
+    
+    def close(self):
+        """Close the shared connections, e.g. when the app shuts down"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        with self._read_pool_lock:
+            if self._read_pool is not None:
+                while not self._read_pool.empty():
+                    self._read_pool.get_nowait().close()
+                self._read_pool = None
+    
     def init_database(self):
         """Initialize the database with required tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS receipts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filename TEXT NOT NULL,
-                file_path TEXT NOT NULL,
-                ocr_text TEXT,
-                restaurant_name TEXT,
-                date TEXT,
-                total_amount REAL,
-                cuenta_contable TEXT DEFAULT 'Comidas con Clientes',
-                pais TEXT DEFAULT 'MX',
-                cc TEXT DEFAULT 'Alternativos',
-                fx_rate REAL DEFAULT 1.0,
-                markup_percent REAL DEFAULT 2.5,
-                amount_mxn REAL,
-                reembolso TEXT,
-                detalle TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                reviewed BOOLEAN DEFAULT FALSE
-            )
-        ''')
+        with self._tx() as cursor:
         
-        # Create categories table for remembering user selections
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                category_type TEXT NOT NULL,
-                category_value TEXT NOT NULL,
-                usage_count INTEGER DEFAULT 1,
-                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(category_type, category_value)
-            )
-        ''')
-        
-        # Create settings table for default values
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS receipts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    filename TEXT NOT NULL,
+                    file_path TEXT NOT NULL,
+                    ocr_text TEXT,
+                    restaurant_name TEXT,
+                    date TEXT,
+                    total_amount REAL,
+                    cuenta_contable TEXT DEFAULT 'Comidas con Clientes',
+                    pais TEXT DEFAULT 'MX',
+                    cc TEXT DEFAULT 'Alternativos',
+                    fx_rate REAL DEFAULT 1.0,
+                    markup_percent REAL DEFAULT 2.5,
+                    amount_mxn REAL,
+                    reembolso TEXT,
+                    detalle TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    reviewed BOOLEAN DEFAULT FALSE
+                )
+            ''')
+        
+            # Create categories table for remembering user selections
+            cursor.execute(self._CREATE_CATEGORIES_SQL.format(table='categories'))
+        
+            # Create settings table for default values
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
 
-        # Add display_filename column if it doesn't exist (migration)
-        try:
-            cursor.execute('ALTER TABLE receipts ADD COLUMN display_filename TEXT')
-            conn.commit()
-        except sqlite3.OperationalError:
-            # Column already exists
-            pass
+            # Create upload jobs table so any worker process can report job progress
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS upload_jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    processed_count INTEGER,
+                    duplicate_count INTEGER,
+                    error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
 
-        conn.commit()
-        conn.close()
+            # Add columns that older databases don't have yet (migrations)
+            columns = {row[1] for row in cursor.execute('PRAGMA table_info(receipts)')}
+            if 'display_filename' not in columns:
+                cursor.execute('ALTER TABLE receipts ADD COLUMN display_filename TEXT')
+            # content_hash is used for spotting re-uploaded files
+            if 'content_hash' not in columns:
+                cursor.execute('ALTER TABLE receipts ADD COLUMN content_hash TEXT')
+            # Older categories tables have an unused id column; rebuild them keyed
+            # on (category_type, category_value) without the extra rowid B-tree
+            if 'id' in {row[1] for row in cursor.execute('PRAGMA table_info(categories)')}:
+                cursor.execute('DROP TABLE IF EXISTS categories_v2')
+                cursor.execute(self._CREATE_CATEGORIES_SQL.format(table='categories_v2'))
+                cursor.execute('''
+                    INSERT INTO categories_v2 (category_type, category_value, usage_count, last_used)
+                    SELECT category_type, category_value, usage_count, last_used FROM categories
+                ''')
+                cursor.execute('DROP TABLE categories')
+                cursor.execute('ALTER TABLE categories_v2 RENAME TO categories')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_receipts_content_hash ON receipts(content_hash)')
+
+            # Indexes for the dashboard order, training examples and category suggestions
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_receipts_created ON receipts(created_at DESC)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_receipts_reviewed_updated ON receipts(reviewed, updated_at DESC)')
+            # Display filenames must be unique, which the database now enforces. Older
+            # databases could hold duplicates, so those keep only the first receipt's.
+            if not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'uq_receipts_display'").fetchone():
+                cursor.execute('''
+                    UPDATE receipts SET display_filename = NULL
+                    WHERE display_filename IS NOT NULL AND id NOT IN (
+                        SELECT MIN(id) FROM receipts WHERE display_filename IS NOT NULL GROUP BY display_filename
+                    )
+                ''')
+                cursor.execute('DROP INDEX IF EXISTS idx_receipts_display')
+                cursor.execute('''
+                    CREATE UNIQUE INDEX uq_receipts_display ON receipts(display_filename)
+                    WHERE display_filename IS NOT NULL
+                ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_receipts_reviewed_name
+                ON receipts(LOWER(COALESCE(display_filename, filename))) WHERE reviewed = TRUE
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_categories_type_count
+                ON categories(category_type, usage_count DESC, last_used DESC)
+            ''')
     
-    def add_receipt(self, filename, file_path, ocr_text, restaurant_name=None, date=None, total_amount=None):
+    def add_receipt(self, filename, file_path, ocr_text, restaurant_name=None, date=None, total_amount=None,
+                    content_hash=None):
         """Add a new receipt to the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        return self.add_receipts([dict(filename=filename, file_path=file_path, ocr_text=ocr_text,
+                                       restaurant_name=restaurant_name, date=date, total_amount=total_amount,
+                                       content_hash=content_hash)])[0]
+    
+    def add_receipts(self, receipts):
+        """Add several receipts (dicts of add_receipt's arguments) in one transaction and return their ids"""
         # Get default FX rate and markup from settings
         default_fx_rate = self.get_default_setting('default_fx_rate', 20.0)
         default_markup = self.get_default_setting('default_markup_percent', 2.5)
         
-        # Calculate USD amount if MXN amount is provided
-        amount_usd = None
-        if total_amount and total_amount > 0:
-            # total_amount is in MXN, convert to USD with default rates
-            amount_usd = total_amount / default_fx_rate
-            amount_usd = amount_usd * (1 + default_markup / 100)
-        
-        cursor.execute('''
-            INSERT INTO receipts (filename, file_path, ocr_text, restaurant_name, date, total_amount, 
-                                fx_rate, markup_percent, amount_mxn)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (filename, file_path, ocr_text, restaurant_name, date, total_amount, 
-              default_fx_rate, default_markup, amount_usd))
-        
-        receipt_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return receipt_id
+        # A single commit for the whole batch instead of one per receipt
+        with self._tx() as cursor:
+            receipt_ids = []
+            for receipt in receipts:
+                # The USD amount is calculated by SQLite from the MXN total and the defaults
+                cursor.execute(self._INSERT_RECEIPT_SQL, (
+                    receipt['filename'], receipt['file_path'], receipt['ocr_text'], receipt.get('restaurant_name'),
+                    receipt.get('date'), receipt.get('total_amount'), default_fx_rate, default_markup,
+                    receipt.get('content_hash')))
+                receipt_ids.append(cursor.lastrowid)
+            return receipt_ids
+    
+    def create_upload_job(self, job_id):
+        """Record a new background upload job as running"""
+        with self._tx() as cursor:
+            cursor.execute('INSERT INTO upload_jobs (id) VALUES (?)', (job_id,))
+    
+    def finish_upload_job(self, job_id, processed_count=0, duplicate_count=0, error=None):
+        """Record the outcome of a background upload job"""
+        with self._tx() as cursor:
+            cursor.execute('''
+                UPDATE upload_jobs SET status = ?, processed_count = ?, duplicate_count = ?, error = ?
+                WHERE id = ?
+            ''', ('error' if error else 'done', processed_count, duplicate_count, error, job_id))
+    
+    def get_upload_job(self, job_id):
+        """Get a background upload job's status and results"""
+        with self._read() as conn:
+            cursor = conn.execute(
+                'SELECT status, processed_count, duplicate_count, error FROM upload_jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            return {'status': row[0], 'processed_count': row[1], 'duplicate_count': row[2], 'error': row[3]}
+    
+    def delete_upload_job(self, job_id):
+        """Forget a background upload job once its result has been shown"""
+        with self._tx() as cursor:
+            cursor.execute('DELETE FROM upload_jobs WHERE id = ?', (job_id,))
+    
+    def find_receipt_by_hash(self, content_hash):
+        """Get the receipt (id, file_path) stored for an uploaded file's content hash, if any"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+        
+            cursor.execute('SELECT id, file_path FROM receipts WHERE content_hash = ? LIMIT 1', (content_hash,))
+            row = cursor.fetchone()
+            return tuple(row) if row else None
+    
+    def get_receipt_file_paths(self):
+        """Get the set of file paths receipts are stored with"""
+        with self._read() as conn:
+            return {row[0] for row in conn.execute('SELECT file_path FROM receipts')}
     
     def get_all_receipts(self):
         """Get all receipts from database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._read() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT id, filename, file_path, ocr_text, restaurant_name, date, total_amount, reviewed,
-                   cuenta_contable, pais, cc, fx_rate, markup_percent, amount_mxn, reembolso, detalle, display_filename
-            FROM receipts ORDER BY created_at DESC
-        ''')
+            cursor.execute(self._SELECT_ALL_RECEIPTS_SQL)
 
-        receipts = cursor.fetchall()
-        conn.close()
-
-        return [
-            {
-                'id': r[0],
-                'filename': r[1],
-                'file_path': r[2],
-                'ocr_text': r[3],
-                'restaurant_name': r[4],
-                'date': r[5],
-                'total_amount': r[6],
-                'reviewed': bool(r[7]),
-                'cuenta_contable': r[8] if len(r) > 8 else 'Comidas con Clientes',
-                'pais': r[9] if len(r) > 9 else 'MX',
-                'cc': r[10] if len(r) > 10 else 'Alternativos',
-                'fx_rate': r[11] if len(r) > 11 else 20.0,
-                'markup_percent': r[12] if len(r) > 12 else 2.5,
-                'amount_mxn': r[13] if len(r) > 13 else None,
-                'reembolso': r[14] if len(r) > 14 else None,
-                'detalle': r[15] if len(r) > 15 else None,
-                'display_filename': r[16] if len(r) > 16 else None
-            }
-            for r in receipts
-        ]
+            # Build the dicts straight from the cursor rather than from a fetchall() copy
+            return [self._receipt_from_row(r) for r in cursor]
+    
+    def get_receipts_for_export(self, order_by_name=False):
+        """Get all reviewed receipts with the columns reports and exports use (no OCR text), newest first or by name"""
+        sql = self._SELECT_EXPORT_RECEIPTS_BY_NAME_SQL if order_by_name else self._SELECT_EXPORT_RECEIPTS_SQL
+        with self._read() as conn:
+            cursor = conn.execute(sql)
+            return [self._receipt_from_row(r) for r in cursor]
+    
+    def _receipt_from_row(self, r):
+        """Build a receipt dictionary from a receipts table row"""
+        receipt = dict(r)
+        receipt['reviewed'] = bool(receipt['reviewed'])
+        return receipt
     
     def get_receipt(self, receipt_id):
         """Get a specific receipt by ID"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._read() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT id, filename, file_path, ocr_text, restaurant_name, date, total_amount, reviewed,
-                   cuenta_contable, pais, cc, fx_rate, markup_percent, amount_mxn, reembolso, detalle, display_filename
-            FROM receipts WHERE id = ?
-        ''', (receipt_id,))
+            cursor.execute(self._SELECT_RECEIPT_SQL, (receipt_id,))
 
-        result = cursor.fetchone()
-        conn.close()
+            result = cursor.fetchone()
 
-        if result:
-            return {
-                'id': result[0],
-                'filename': result[1],
-                'file_path': result[2],
-                'ocr_text': result[3],
-                'restaurant_name': result[4],
-                'date': result[5],
-                'total_amount': result[6],
-                'reviewed': bool(result[7]),
-                'cuenta_contable': result[8] if len(result) > 8 else 'Comidas con Clientes',
-                'pais': result[9] if len(result) > 9 else 'MX',
-                'cc': result[10] if len(result) > 10 else 'Alternativos',
-                'fx_rate': result[11] if len(result) > 11 else 20.0,
-                'markup_percent': result[12] if len(result) > 12 else 2.5,
-                'amount_mxn': result[13] if len(result) > 13 else None,
-                'reembolso': result[14] if len(result) > 14 else None,
-                'detalle': result[15] if len(result) > 15 else None,
-                'display_filename': result[16] if len(result) > 16 else None
-            }
-        return None
+            if result:
+                return self._receipt_from_row(result)
+            return None
     
     def update_receipt(self, receipt_id, restaurant_name=None, date=None, total_amount=None,
                       cuenta_contable=None, cc=None, fx_rate=None, markup_percent=None, reembolso=None, detalle=None):
-        """Update receipt data with all new fields"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Calculate USD amount (receipts are in MXN, convert to USD)
+        """Update receipt data with all new fields and return the assigned display filename"""
+        # Calculate USD amount before taking the lock (receipts are in MXN: divide by
+        # the FX rate and apply the markup). A zero FX rate leaves it unset.
         amount_usd = None
         if total_amount and fx_rate:
-            # total_amount is in MXN, divide by FX rate to get USD
-            amount_usd = total_amount / fx_rate
-            # Apply markup to USD amount
-            amount_usd = amount_usd * (1 + (markup_percent or 2.5) / 100)
+            amount_usd = total_amount * (1 + (markup_percent or 2.5) / 100) / fx_rate
 
-        # Generate display_filename
-        display_filename = None
-        if date and restaurant_name:
-            formatted_name = format_receipt_filename(date, restaurant_name)
-            if formatted_name:
-                # Get all existing display filenames to check for duplicates
-                cursor.execute('SELECT display_filename FROM receipts WHERE id != ? AND reviewed = TRUE', (receipt_id,))
-                existing_filenames = {row[0].replace('.pdf', '') for row in cursor.fetchall() if row[0]}
+        with self._tx() as cursor:
+            display_filename = self._execute_with_display_filename(
+                cursor, self._UPDATE_RECEIPT_SQL, date, restaurant_name,
+                lambda name: (restaurant_name, date, total_amount, cuenta_contable, cc, fx_rate, markup_percent, amount_usd, reembolso, detalle, name, receipt_id),
+                receipt_id=receipt_id)
 
-                # Check if this formatted name already exists
-                counter = 1
-                test_name = formatted_name
-                while test_name in existing_filenames:
+            # Remember category selections in the same transaction as the update
+            self._remember_categories(cursor, [
+                (category_type, category_value) for category_type, category_value in
+                (('cuenta_contable', cuenta_contable), ('cc', cc), ('reembolso', reembolso))
+                if category_value
+            ])
+        
+            return display_filename
+    
+    def _execute_with_display_filename(self, cursor, sql, date, restaurant_name, make_params, receipt_id=None):
+        """Run a statement that sets display_filename, suffixing _2, _3, ... until the name is free"""
+        formatted_name = format_receipt_filename(date, restaurant_name) if date and restaurant_name else None
+        counter = 1
+        while True:
+            display_filename = None
+            if formatted_name:
+                display_filename = f"{formatted_name}.pdf" if counter == 1 else f"{formatted_name}_{counter}.pdf"
+            try:
+                cursor.execute(sql, make_params(display_filename))
+                return display_filename
+            except sqlite3.IntegrityError as e:
+                # uq_receipts_display rejected a name another receipt has
+                if not display_filename or 'display_filename' not in str(e):
+                    raise
+                if counter > 1:
                     counter += 1
-                    test_name = f"{formatted_name}_{counter}"
-
-                display_filename = f"{test_name}.pdf"
-
-        cursor.execute('''
-            UPDATE receipts
-            SET restaurant_name = ?, date = ?, total_amount = ?, cuenta_contable = ?,
-                cc = ?, fx_rate = ?, markup_percent = ?, amount_mxn = ?, reembolso = ?, detalle = ?,
-                display_filename = ?, reviewed = TRUE, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (restaurant_name, date, total_amount, cuenta_contable, cc, fx_rate, markup_percent, amount_usd, reembolso, detalle, display_filename, receipt_id))
-
-        conn.commit()
-        conn.close()
-        
-        # Remember category selections (after closing the main connection)
-        if cuenta_contable:
-            self._remember_category('cuenta_contable', cuenta_contable)
-        if cc:
-            self._remember_category('cc', cc)
-        if reembolso:
-            self._remember_category('reembolso', reembolso)
-    
-    def _remember_category(self, category_type, category_value):
-        """Remember a category selection for future use"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO categories (category_type, category_value, usage_count, last_used)
-            VALUES (?, ?, COALESCE((SELECT usage_count FROM categories WHERE category_type = ? AND category_value = ?), 0) + 1, CURRENT_TIMESTAMP)
-        ''', (category_type, category_value, category_type, category_value))
-        
-        conn.commit()
-        conn.close()
+                    continue
+                # Fetch every suffixed name other receipts use with one range scan of
+                # the index ('`' sorts right after '_') and jump to the first free suffix
+                taken = {row[0] for row in cursor.execute('''
+                    SELECT display_filename FROM receipts
+                    WHERE display_filename >= ? AND display_filename < ? AND id IS NOT ?
+                ''', (f"{formatted_name}_", f"{formatted_name}`", receipt_id))}
+                counter = 2
+                while f"{formatted_name}_{counter}.pdf" in taken:
+                    counter += 1
+    
+    def _remember_categories(self, cursor, pairs):
+        """Remember (category_type, category_value) selections for future use, inside the caller's transaction"""
+        # Upsert keeps the existing row and bumps its count in a single lookup
+        cursor.executemany('''
+            INSERT INTO categories (category_type, category_value) VALUES (?, ?)
+            ON CONFLICT(category_type, category_value)
+            DO UPDATE SET usage_count = usage_count + 1, last_used = CURRENT_TIMESTAMP
+        ''', pairs)
     
     def get_remembered_categories(self, category_type):
         """Get previously used categories, ordered by usage frequency"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._read() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT DISTINCT category_value, usage_count FROM categories 
-            WHERE category_type = ? 
-            ORDER BY usage_count DESC, last_used DESC
-        ''', (category_type,))
-        
-        results = cursor.fetchall()
-        conn.close()
+            # (category_type, category_value) is the primary key, so each value comes back once
+            cursor.execute('''
+                SELECT category_value FROM categories 
+                WHERE category_type = ? 
+                ORDER BY usage_count DESC, last_used DESC
+            ''', (category_type,))
         
-        # Ensure uniqueness in case DISTINCT didn't fully handle it
-        seen = set()
-        unique_results = []
-        for r in results:
-            if r[0] not in seen:
-                seen.add(r[0])
-                unique_results.append(r[0])
+            return [r[0] for r in cursor.fetchall()]
+    
+    def get_data_fingerprint(self):
+        """Get a cheap value that changes whenever a receipt is added, edited or removed"""
+        with self._read() as conn:
+            cursor = conn.cursor()
         
-        return unique_results
+            cursor.execute('SELECT COUNT(*), MAX(id), MAX(updated_at) FROM receipts')
+            return tuple(cursor.fetchone())
     
     def get_training_examples(self, limit=5):
         """Get successfully corrected receipts as training examples"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._read() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT ocr_text, restaurant_name, date, total_amount
-            FROM receipts 
-            WHERE reviewed = TRUE 
-            AND restaurant_name IS NOT NULL 
-            AND date IS NOT NULL 
-            AND total_amount IS NOT NULL
-            ORDER BY updated_at DESC
-            LIMIT ?
-        ''', (limit,))
-        
-        examples = cursor.fetchall()
-        conn.close()
-        
-        return [
-            {
-                'ocr_text': e[0],
-                'restaurant_name': e[1],
-                'date': e[2],
-                'total_amount': e[3]
-            }
-            for e in examples
-        ]
+            cursor.execute('''
+                SELECT ocr_text, restaurant_name, date, total_amount
+                FROM receipts 
+                WHERE reviewed = TRUE 
+                AND restaurant_name IS NOT NULL 
+                AND date IS NOT NULL 
+                AND total_amount IS NOT NULL
+                ORDER BY updated_at DESC
+                LIMIT ?
+            ''', (limit,))
+        
+            examples = cursor.fetchall()
+        
+            return [
+                {
+                    'ocr_text': e[0],
+                    'restaurant_name': e[1],
+                    'date': e[2],
+                    'total_amount': e[3]
+                }
+                for e in examples
+            ]
+    
+    def get_training_examples_version(self):
+        """Get a value that changes whenever a receipt is confirmed or re-edited in review"""
+        with self._read() as conn:
+            # Served from idx_receipts_reviewed_updated without a table scan
+            row = conn.execute('SELECT MAX(updated_at) FROM receipts WHERE reviewed = TRUE').fetchone()
+            return row[0]
     
     def delete_receipt(self, receipt_id):
         """Delete a receipt from the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Check if receipt exists
-        cursor.execute('SELECT id FROM receipts WHERE id = ?', (receipt_id,))
-        if not cursor.fetchone():
-            conn.close()
-            return False
+        with self._tx() as cursor:
         
-        # Delete the receipt
-        cursor.execute('DELETE FROM receipts WHERE id = ?', (receipt_id,))
-        conn.commit()
-        conn.close()
-        return True
+            # RETURNING reports whether a row existed without a separate SELECT
+            cursor.execute('DELETE FROM receipts WHERE id = ? RETURNING id', (receipt_id,))
+            deleted = cursor.fetchone() is not None
+            return deleted
     
     def duplicate_receipt_with_cc_split(self, receipt_id, cost_centers):
         """Create duplicate receipts split across cost centers and delete original"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Get original receipt
-        cursor.execute('''
-            SELECT filename, file_path, ocr_text, restaurant_name, date, total_amount, 
-                   cuenta_contable, pais, fx_rate, markup_percent, amount_mxn, reembolso, detalle
-            FROM receipts WHERE id = ?
-        ''', (receipt_id,))
-        
-        receipt = cursor.fetchone()
-        if not receipt:
-            conn.close()
-            return False
+        with self._tx() as cursor:
         
-        # Calculate split amount
-        split_amount = receipt[5] / len(cost_centers) if receipt[5] else 0
-        split_amount_mxn = receipt[10] / len(cost_centers) if receipt[10] else 0
-        
-        # Create new receipts for each cost center
-        for cc in cost_centers:
+            # Get original receipt
             cursor.execute('''
-                INSERT INTO receipts (filename, file_path, ocr_text, restaurant_name, date, total_amount,
-                                    cuenta_contable, pais, cc, fx_rate, markup_percent, amount_mxn, 
-                                    reembolso, detalle, reviewed)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, TRUE)
-            ''', (receipt[0], receipt[1], receipt[2], receipt[3], receipt[4], split_amount,
-                  receipt[6], receipt[7], cc, receipt[8], receipt[9], split_amount_mxn,
-                  receipt[11], receipt[12]))
-        
-        # Delete original receipt
-        cursor.execute('DELETE FROM receipts WHERE id = ?', (receipt_id,))
-        
-        conn.commit()
-        conn.close()
-        return True
+                SELECT filename, file_path, ocr_text, restaurant_name, date, total_amount, 
+                       cuenta_contable, pais, fx_rate, markup_percent, amount_mxn, reembolso, detalle
+                FROM receipts WHERE id = ?
+            ''', (receipt_id,))
+        
+            receipt = cursor.fetchone()
+            if not receipt:
+                return False
+        
+            # Calculate split amount
+            split_amount = receipt[5] / len(cost_centers) if receipt[5] else 0
+            split_amount_mxn = receipt[10] / len(cost_centers) if receipt[10] else 0
+        
+            # Delete the original first, so its display filename is free for the copies
+            cursor.execute('DELETE FROM receipts WHERE id = ?', (receipt_id,))
+        
+            # Create new receipts for each cost center, each with its own display filename
+            for cc in cost_centers:
+                self._execute_with_display_filename(cursor, '''
+                    INSERT INTO receipts (filename, file_path, ocr_text, restaurant_name, date, total_amount,
+                                        cuenta_contable, pais, cc, fx_rate, markup_percent, amount_mxn, 
+                                        reembolso, detalle, display_filename, reviewed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, TRUE)
+                ''', receipt[4], receipt[3],
+                    lambda name: (receipt[0], receipt[1], receipt[2], receipt[3], receipt[4], split_amount,
+                                  receipt[6], receipt[7], cc, receipt[8], receipt[9], split_amount_mxn,
+                                  receipt[11], receipt[12], name))
+        
+            return True
     
     def add_cost_center(self, cost_center_name):
         """Add a new cost center to the categories"""
-        self._remember_category('cc', cost_center_name)
+        with self._tx() as cursor:
+            self._remember_categories(cursor, [('cc', cost_center_name)])
     
     def set_default_setting(self, key, value):
         """Set a default setting value"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._tx() as cursor:
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO settings (key, value, updated_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-        ''', (key, str(value)))
-        
-        conn.commit()
-        conn.close()
+            cursor.execute('''
+                INSERT OR REPLACE INTO settings (key, value, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+            ''', (key, str(value)))
+
+        self._settings[key] = self._parse_setting(str(value))
     
     def get_default_setting(self, key, default_value=None):
         """Get a default setting value"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-        result = cursor.fetchone()
-        
-        conn.close()
-        
-        if result:
-            try:
-                return float(result[0])
-            except ValueError:
-                return result[0]
-        return default_value
+        with self._read() as conn:
+            # data_version changes when any other connection commits. It is
+            # per connection, so the version each reader loaded at is kept.
+            if conn.execute('PRAGMA data_version').fetchone()[0] != self._settings_versions.get(conn):
+                self._load_settings(conn)
+            return self._settings.get(key, default_value)
+    
+    def _load_settings(self, conn):
+        """Read the settings table into the in-process cache"""
+        self._settings = {key: self._parse_setting(value)
+                          for key, value in conn.execute('SELECT key, value FROM settings')}
+        self._settings_versions[conn] = conn.execute('PRAGMA data_version').fetchone()[0]
+    
+    @staticmethod
+    def _parse_setting(value):
+        """Convert a stored setting to a float when it is numeric"""
+        try:
+            return float(value)
+        except ValueError:
+            return value
     
     def update_all_fx_rates(self, new_fx_rate, markup_percent=2.5):
         """Update FX rate for all receipts and store as default for future receipts"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Store as default for future receipts
-        cursor.execute('''
-            INSERT OR REPLACE INTO settings (key, value, updated_at)
-            VALUES ('default_fx_rate', ?, CURRENT_TIMESTAMP)
-        ''', (new_fx_rate,))
+        with self._tx() as cursor:
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO settings (key, value, updated_at)
-            VALUES ('default_markup_percent', ?, CURRENT_TIMESTAMP)
-        ''', (markup_percent,))
-        
-        # Get all receipts with MXN amounts
-        cursor.execute('SELECT id, total_amount FROM receipts WHERE total_amount IS NOT NULL')
-        receipts = cursor.fetchall()
+            # Store as default for future receipts
+            cursor.execute('''
+                INSERT OR REPLACE INTO settings (key, value, updated_at)
+                VALUES ('default_fx_rate', ?, CURRENT_TIMESTAMP)
+            ''', (new_fx_rate,))
         
-        updated_count = 0
-        for receipt_id, total_amount_mxn in receipts:
-            if total_amount_mxn and total_amount_mxn > 0:
-                # Calculate new USD amount
-                usd_base = total_amount_mxn / new_fx_rate
-                usd_with_markup = usd_base * (1 + markup_percent / 100)
-                
-                # Update the receipt
-                cursor.execute('''
-                    UPDATE receipts 
-                    SET fx_rate = ?, markup_percent = ?, amount_mxn = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (new_fx_rate, markup_percent, usd_with_markup, receipt_id))
-                
-                updated_count += 1
+            cursor.execute('''
+                INSERT OR REPLACE INTO settings (key, value, updated_at)
+                VALUES ('default_markup_percent', ?, CURRENT_TIMESTAMP)
+            ''', (markup_percent,))
         
-        conn.commit()
-        conn.close()
+            # Recalculate every USD amount in one statement instead of row by row
+            cursor.execute('''
+                UPDATE receipts
+                SET fx_rate = ?, markup_percent = ?,
+                    amount_mxn = total_amount / ? * (1 + ? / 100.0),
+                    updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+                WHERE total_amount IS NOT NULL AND total_amount > 0
+            ''', (new_fx_rate, markup_percent, new_fx_rate, markup_percent))
+            updated_count = cursor.rowcount
+
+        self._settings['default_fx_rate'] = self._parse_setting(str(new_fx_rate))
+        self._settings['default_markup_percent'] = self._parse_setting(str(markup_percent))
         return updated_count
     
     def clear_all_receipts(self):
         """Delete all receipts from the database and their files"""
-        import os
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Get all file paths before deleting
-        cursor.execute('SELECT file_path FROM receipts WHERE file_path IS NOT NULL')
-        file_paths = [row[0] for row in cursor.fetchall()]
+        with self._tx() as cursor:
         
-        # Delete files
-        deleted_files = 0
-        for file_path in file_paths:
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    deleted_files += 1
-                except Exception as e:
-                    print(f"Error deleting file {file_path}: {e}")
+            # Get all file paths before deleting (split receipts share a file)
+            cursor.execute('SELECT DISTINCT file_path FROM receipts WHERE file_path IS NOT NULL')
+            file_paths = [row[0] for row in cursor.fetchall()]
         
-        # Delete all receipts from database
-        cursor.execute('DELETE FROM receipts')
-        deleted_records = cursor.rowcount
+            # Delete all receipts from database
+            cursor.execute('DELETE FROM receipts')
+            deleted_records = cursor.rowcount
         
-        conn.commit()
-        conn.close()
+        # Delete files in parallel, outside the lock - this is all filesystem waits
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            deleted_files = sum(executor.map(_remove_file, file_paths))
         
         return deleted_records, deleted_files
     
-    def export_to_csv(self):
-        """Export all receipts to CSV format"""
-        import pandas as pd
-        
-        receipts = self.get_all_receipts()
-        if not receipts:
-            return None
-        
-        df = pd.DataFrame(receipts)
-        df = df[['filename', 'restaurant_name', 'date', 'total_amount', 'reviewed']]
-        
-        return df
\ No newline at end of file
+    def stream_csv(self, chunk_size=500):
+        """Yield the receipts CSV export in chunks of rows, without building it in memory"""
+        # Use a dedicated connection - the response streams after the request ends
+        conn = self._connect()
+        try:
+            # reviewed is written as True/False, as the pandas export did
+            cursor = conn.execute('''
+                SELECT filename, restaurant_name, date, total_amount,
+                       CASE WHEN reviewed THEN 'True' ELSE 'False' END AS reviewed
+                FROM receipts ORDER BY created_at DESC
+            ''')
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow([column[0] for column in cursor.description])
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+        finally:
+            conn.close()
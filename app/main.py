@@ -1,32 +1,91 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, stream_with_context
+from flask_compress import Compress
+from werkzeug.utils import secure_filename
 import os
+import io
+import atexit
+import shutil
+import re
+import uuid
+import threading
+import time
+import hashlib
+import math
+import mimetypes
+import orjson
 from core.expense_reader import ExpenseReader
 from app.database import ExpenseDatabase
-from core.file_utils import format_receipt_filename, get_export_folder, get_unique_filename, export_organized_receipts, add_display_filenames_to_receipts
-import base64
-from io import BytesIO
-import pandas as pd
-from pathlib import Path
+from generators.pdf_generator import ExpensePDFGenerator
+from generators.excel_generator import ExcelExpenseGenerator
+from core.file_utils import get_export_folder, get_unique_filename, export_organized_receipts, create_thumbnail
+from datetime import datetime
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'
 
-# Initialize components
-reader = ExpenseReader()
+# Compress HTML, JSON and CSV responses (Brotli or gzip, per Accept-Encoding)
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'text/css', 'text/javascript', 'application/javascript',
+                                    'application/json', 'text/csv']
+Compress(app)
+
+# Let the front-end server send receipt files instead of this process:
+# USE_X_SENDFILE=1 for Apache/lighttpd, or X_ACCEL_REDIRECT_PREFIX for an
+# nginx internal location aliased to the data/ folder (e.g. /internal/)
+app.use_x_sendfile = os.getenv('USE_X_SENDFILE') == '1'
+X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX')
+# Likewise for generated reports, with a location aliased to the export folder
+X_ACCEL_EXPORT_PREFIX = os.getenv('X_ACCEL_EXPORT_PREFIX')
+
+# Initialize components (the reader shares the app's database for training examples)
 db = ExpenseDatabase()
+reader = ExpenseReader(db=db)
+atexit.register(db.close)
+
+# Number of server processes (set by gunicorn.conf.py); the pools below are
+# split between them so the whole server stays within one set of limits
+WORKER_COUNT = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+
+# Shared pool for OCR and thumbnails - tesseract runs as a subprocess per
+# image, so one thread per core keeps every core busy
+executor = ThreadPoolExecutor(max_workers=max(1, os.cpu_count() // WORKER_COUNT))
+
+# AI extraction only waits on the OpenAI API, so it gets a wider pool of its
+# own. OPENAI_MAX_CONCURRENCY is the account's rate limit for the whole
+# server, so each process takes its share of it.
+llm_executor = ThreadPoolExecutor(
+    max_workers=max(1, int(os.getenv('OPENAI_MAX_CONCURRENCY', '16')) // WORKER_COUNT))
+
+# Upload jobs run in the background so the request returns right away.
+# They get their own small pool because they wait on work in the pool above.
+# Job status lives in the database so any worker process can answer a poll.
+job_executor = ThreadPoolExecutor(max_workers=2)
+
+# Uploaded receipt files
+UPLOAD_DIR = 'data/uploads'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+# Dashboard previews, one small JPEG per receipt named after its id
+THUMBNAIL_DIR = 'data/thumbnails'
+
+# Reembolso suggestions are fetched on every keystroke but only change when a
+# receipt is saved, so keep them for a short while between saves
+SUGGESTIONS_TTL = 30
+_suggestions_cache = {}
+
+# Last generated file per report, reused while the receipts are unchanged.
+# One lock per report so concurrent requests don't generate it twice.
+_export_cache = {}
+_export_locks = {'pdf': threading.Lock(), 'pdf-summary': threading.Lock(), 'excel': threading.Lock()}
 
 @app.route('/')
 def index():
     """Main dashboard showing all receipts"""
+    # display_filename is stored when a receipt is reviewed; the template
+    # falls back to the original filename for the rest
     receipts = db.get_all_receipts()
-
-    # For receipts without display_filename (legacy data), generate them on-the-fly
-    # New receipts will have display_filename set when they're reviewed
-    for receipt in receipts:
-        if not receipt.get('display_filename'):
-            # Fallback to original filename for unreviewed or legacy receipts
-            receipt['display_filename'] = receipt['filename']
-
     return render_template('index.html', receipts=receipts)
 
 @app.route('/upload', methods=['GET', 'POST'])
@@ -38,41 +97,145 @@ def upload():
             return redirect(request.url)
         
         files = request.files.getlist('files[]')
-        processed_count = 0
+        saved_files = []
+        
+        # Names on disk or held by a receipt are never reused, so an upload can't
+        # overwrite another receipt's file
+        taken_names = {entry.name for entry in os.scandir(UPLOAD_DIR)}
+        taken_names.update(os.path.basename(path) for path in db.get_receipt_file_paths() if path)
         
         for file in files:
             if file.filename == '':
                 continue
             
             if file and allowed_file(file.filename):
-                # Save uploaded file
-                filename = file.filename
-                upload_path = os.path.join('data/uploads', filename)
-                os.makedirs('data/uploads', exist_ok=True)
-                file.save(upload_path)
-                
-                # Process with OCR or PDF extraction
-                extracted_text = reader.extract_text_from_file(upload_path)
-                if extracted_text:
-                    # Extract data with AI
-                    receipt_data = reader.extract_receipt_data(extracted_text)
-                    
-                    # Save to database
-                    db.add_receipt(
-                        filename=filename,
-                        file_path=upload_path,
-                        ocr_text=extracted_text,
-                        restaurant_name=receipt_data.get('restaurant_name') if receipt_data else None,
-                        date=receipt_data.get('date') if receipt_data else None,
-                        total_amount=receipt_data.get('total_amount') if receipt_data else None
-                    )
-                    processed_count += 1
+                # Save uploaded file under a safe name, hashing it on the way to disk
+                filename = secure_filename(file.filename)
+                if not allowed_file(filename):
+                    # Nothing usable was left of the name (e.g. all non-ASCII)
+                    filename = uuid.uuid4().hex + os.path.splitext(file.filename)[1].lower()
+                base_name, extension = os.path.splitext(filename)
+                while True:
+                    filename = get_unique_filename(UPLOAD_DIR, base_name, extension, taken_names)
+                    upload_path = os.path.join(UPLOAD_DIR, filename)
+                    try:
+                        content_hash = save_upload(file, upload_path)
+                        break
+                    except FileExistsError:
+                        # Another request claimed the name first
+                        continue
+                saved_files.append((filename, upload_path, content_hash))
         
-        flash(f'Successfully processed {processed_count} receipts')
-        return redirect(url_for('index'))
+        # Hand the saved files to a background job and let the browser poll it
+        job_id = uuid.uuid4().hex
+        db.create_upload_job(job_id)
+        job_executor.submit(run_upload_job, job_id, saved_files)
+        return redirect(url_for('upload_job', job_id=job_id))
     
     return render_template('upload.html')
 
+def save_upload(file, upload_path):
+    """Write an uploaded file to a new file on disk and return the hash of its contents"""
+    hasher = hashlib.blake2b()
+    # Unbuffered writes of 1 MiB chunks - hashing and writing share one pass.
+    # 'x' refuses to replace an existing file.
+    with open(upload_path, 'xb', buffering=0) as out:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+            out.write(chunk)
+    return hasher.hexdigest()
+
+def run_upload_job(job_id, saved_files):
+    """Process saved uploads in the background and record the outcome of the job"""
+    try:
+        processed_count, duplicate_count = process_uploaded_files(saved_files)
+        db.finish_upload_job(job_id, processed_count, duplicate_count)
+    except Exception as e:
+        db.finish_upload_job(job_id, error=str(e))
+
+def referenced_file_paths():
+    """Get the absolute paths of every file a receipt still points at"""
+    return {os.path.abspath(path) for path in db.get_receipt_file_paths() if path}
+
+def process_uploaded_files(saved_files):
+    """Run OCR and AI extraction on saved uploads and store the results"""
+    # Files already stored as a receipt (or repeated in this batch) skip OCR
+    new_files = []
+    seen_paths = {}
+    duplicate_count = 0
+    referenced_paths = None
+    for filename, upload_path, content_hash in saved_files:
+        existing = db.find_receipt_by_hash(content_hash)
+        kept_path = existing[1] if existing else seen_paths.get(content_hash)
+        if kept_path:
+            duplicate_count += 1
+            # Keep only the copy the existing receipt points at, and never a file
+            # that any receipt references
+            if referenced_paths is None:
+                referenced_paths = referenced_file_paths()
+            if (os.path.abspath(kept_path) != os.path.abspath(upload_path) and
+                    os.path.abspath(upload_path) not in referenced_paths):
+                os.remove(upload_path)
+            continue
+        seen_paths[content_hash] = upload_path
+        new_files.append((filename, upload_path, content_hash))
+    saved_files = new_files
+    
+    # Process with OCR or PDF extraction, all files in parallel
+    extracted_texts = reader.extract_text_from_files(
+        [upload_path for _, upload_path, _ in saved_files], executor=executor)
+    
+    # Extract data with AI, several receipts per request and the requests in
+    # parallel (files without text are skipped)
+    receipt_data_list = reader.extract_receipt_data_batch(extracted_texts, executor=llm_executor)
+    
+    # Save to database from this one thread in a single transaction - SQLite
+    # only has one writer, and one commit costs less than one per receipt
+    new_receipts = []
+    for (filename, upload_path, content_hash), extracted_text, receipt_data in zip(saved_files, extracted_texts, receipt_data_list):
+        if not extracted_text:
+            continue
+        
+        new_receipts.append(dict(
+            filename=filename,
+            file_path=upload_path,
+            ocr_text=extracted_text,
+            restaurant_name=receipt_data.get('restaurant_name') if receipt_data else None,
+            date=receipt_data.get('date') if receipt_data else None,
+            total_amount=receipt_data.get('total_amount') if receipt_data else None,
+            content_hash=content_hash
+        ))
+    receipt_ids = db.add_receipts(new_receipts) if new_receipts else []
+    processed_count = len(receipt_ids)
+    thumbnail_jobs = [(receipt['file_path'], thumbnail_path(receipt_id))
+                      for receipt, receipt_id in zip(new_receipts, receipt_ids)
+                      if not receipt['file_path'].lower().endswith('.pdf')]
+    
+    # Build the dashboard previews now so the first page load doesn't have to
+    list(executor.map(lambda paths: create_thumbnail(*paths), thumbnail_jobs))
+    
+    return processed_count, duplicate_count
+
+@app.route('/jobs/<job_id>')
+def upload_job(job_id):
+    """Show progress of a background upload job until it finishes"""
+    job = db.get_upload_job(job_id)
+    if job is None:
+        flash('Upload job not found')
+        return redirect(url_for('index'))
+    
+    if job['status'] == 'running':
+        return render_template('job.html'), 202
+    
+    db.delete_upload_job(job_id)
+    if job['status'] == 'error':
+        flash(f"Error processing receipts: {job['error']}")
+    else:
+        flash(f"Successfully processed {job['processed_count']} receipts")
+        if job['duplicate_count']:
+            flash(f"Skipped {job['duplicate_count']} duplicate receipts already uploaded")
+    return redirect(url_for('index'))
+
 @app.route('/review/<int:receipt_id>')
 def review(receipt_id):
     """Review and edit a specific receipt"""
@@ -82,19 +245,74 @@ def review(receipt_id):
         return redirect(url_for('index'))
     
     # Handle file display based on type
-    image_data = None
+    has_image = False
     is_pdf = False
     if os.path.exists(receipt['file_path']):
-        file_extension = os.path.splitext(receipt['file_path'])[1].lower()
-        if file_extension == '.pdf':
+        if receipt['file_path'].lower().endswith('.pdf'):
             is_pdf = True
             # For PDFs, we'll just provide the file path for download/viewing
         else:
-            # For images, convert to base64 for display
-            with open(receipt['file_path'], 'rb') as f:
-                image_data = base64.b64encode(f.read()).decode()
+            # For images, the template loads the file from the receipt_image route
+            has_image = True
+    
+    return render_template('review.html', receipt=receipt, has_image=has_image, is_pdf=is_pdf)
+
+@app.route('/receipt/<int:receipt_id>/image')
+def receipt_image(receipt_id):
+    """Serve the receipt image file for display"""
+    receipt = db.get_receipt(receipt_id)
+    if not receipt or not os.path.exists(receipt['file_path']):
+        return 'Receipt image not found', 404
     
-    return render_template('review.html', receipt=receipt, image_data=image_data, is_pdf=is_pdf)
+    # Conditional responses let the browser revalidate with a 304 on re-visits
+    return send_data_file(receipt['file_path'], conditional=True, max_age=3600)
+
+def send_data_file(path, max_age=None, root='data', accel_prefix=None, **kwargs):
+    """Send a file stored under root (data/ by default), through nginx when X-Accel-Redirect is configured"""
+    accel_prefix = accel_prefix or (X_ACCEL_REDIRECT_PREFIX if root == 'data' else None)
+    relative_path = os.path.relpath(path, root)
+    if not accel_prefix or relative_path.startswith('..'):
+        # Stored paths are relative to the working directory, not the app package
+        response = send_file(os.path.abspath(path), max_age=max_age, **kwargs)
+    else:
+        mimetype = kwargs.get('mimetype') or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + quote(relative_path.replace(os.sep, '/'))
+        response.cache_control.max_age = max_age
+        if kwargs.get('as_attachment'):
+            response.headers.set('Content-Disposition', 'attachment',
+                                 filename=kwargs.get('download_name') or os.path.basename(path))
+    if max_age is not None:
+        # Receipts are personal, so only the user's browser may keep a copy,
+        # never a shared proxy cache
+        response.cache_control.public = False
+        response.cache_control.private = True
+    return response
+
+def send_report_file(path, download_name):
+    """Send a generated report as a download, through nginx when X_ACCEL_EXPORT_PREFIX is set"""
+    return send_data_file(path, root=get_export_folder(), accel_prefix=X_ACCEL_EXPORT_PREFIX,
+                          as_attachment=True, download_name=download_name)
+
+def thumbnail_path(receipt_id):
+    """Get where the dashboard thumbnail for a receipt is stored"""
+    return os.path.join(THUMBNAIL_DIR, f'{receipt_id}.jpg')
+
+@app.route('/receipt/<int:receipt_id>/thumb')
+def receipt_thumbnail(receipt_id):
+    """Serve a small preview of the receipt image, creating it on first request"""
+    receipt = db.get_receipt(receipt_id)
+    if not receipt or not os.path.exists(receipt['file_path']):
+        return 'Receipt image not found', 404
+    
+    # Rebuild if missing (older receipts) or if the upload was replaced since
+    thumb_path = thumbnail_path(receipt_id)
+    if (not os.path.exists(thumb_path)
+            or os.path.getmtime(thumb_path) < os.path.getmtime(receipt['file_path'])):
+        if not create_thumbnail(receipt['file_path'], thumb_path):
+            return 'Receipt image not found', 404
+    
+    return send_data_file(thumb_path, conditional=True, max_age=86400)
 
 @app.route('/view-pdf/<int:receipt_id>')
 def view_pdf(receipt_id):
@@ -104,12 +322,11 @@ def view_pdf(receipt_id):
         flash('Receipt file not found')
         return redirect(url_for('index'))
     
-    file_extension = os.path.splitext(receipt['file_path'])[1].lower()
-    if file_extension != '.pdf':
+    if not receipt['file_path'].lower().endswith('.pdf'):
         flash('File is not a PDF')
         return redirect(url_for('review', receipt_id=receipt_id))
     
-    return send_file(receipt['file_path'], as_attachment=False, mimetype='application/pdf')
+    return send_data_file(receipt['file_path'], as_attachment=False, mimetype='application/pdf')
 
 @app.route('/update/<int:receipt_id>', methods=['POST'])
 def update_receipt(receipt_id):
@@ -124,26 +341,22 @@ def update_receipt(receipt_id):
     reembolso = request.form.get('reembolso')
     detalle = request.form.get('detalle')
     
-    # Convert numeric fields
+    # Convert numeric fields, tolerating currency symbols and thousands separators
     try:
-        total_amount = float(total_amount) if total_amount else None
-        fx_rate = float(fx_rate) if fx_rate else None
-        markup_percent = float(markup_percent) if markup_percent else None
+        total_amount, fx_rate, markup_percent = (
+            parse_number(value) for value in (total_amount, fx_rate, markup_percent))
     except ValueError:
         flash('Invalid numeric values provided')
         return redirect(url_for('review', receipt_id=receipt_id))
     
-    # Update receipt with all new fields
-    db.update_receipt(receipt_id, restaurant_name, date, total_amount,
-                     cuenta_contable, cc, fx_rate, markup_percent, reembolso, detalle)
-
-    # Generate intended filename for export (yyyy_mm_RestaurantName)
-    if date and restaurant_name:
-        intended_filename = format_receipt_filename(date, restaurant_name)
-        if intended_filename:
-            flash(f'Receipt updated successfully. Will export as: {intended_filename}.pdf')
-        else:
-            flash('Receipt updated successfully')
+    # Update receipt with all new fields - the database assigns the export
+    # filename (yyyy_mm_RestaurantName, suffixed if already taken)
+    display_filename = db.update_receipt(receipt_id, restaurant_name, date, total_amount,
+                                         cuenta_contable, cc, fx_rate, markup_percent, reembolso, detalle)
+    _suggestions_cache.clear()
+
+    if display_filename:
+        flash(f'Receipt updated successfully. Will export as: {display_filename}')
     else:
         flash('Receipt updated successfully')
     return redirect(url_for('index'))
@@ -151,39 +364,69 @@ def update_receipt(receipt_id):
 @app.route('/export')
 def export():
     """Export all receipts to CSV"""
-    df = db.export_to_csv()
-    if df is None:
+    receipt_count = db.get_data_fingerprint()[0]
+    if not receipt_count:
         flash('No receipts to export')
         return redirect(url_for('index'))
     
-    # Save to temporary file
-    csv_path = 'expense_report.csv'
-    df.to_csv(csv_path, index=False)
-    
-    return send_file(csv_path, as_attachment=True, download_name='expense_report.csv')
+    # Stream the CSV straight from the database instead of writing a temporary file
+    return Response(stream_with_context(db.stream_csv()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=expense_report.csv'})
+
+def get_cached_export(kind, output_path, generate):
+    """Return the path of a generated report, regenerating it only if the receipts changed"""
+    output_path = str(output_path)
+    fingerprint = db.get_data_fingerprint()
+    with _export_locks[kind]:
+        cached = _export_cache.get(kind)
+        if cached and cached[0] == (fingerprint, output_path) and os.path.exists(cached[1]):
+            return cached[1]
+        
+        # Other gunicorn workers may be serving or rebuilding the same report, so
+        # write a private copy next to it and swap it in once it is complete
+        root, extension = os.path.splitext(output_path)
+        temp_path = f'{root}.{os.getpid()}.{threading.get_ident()}.tmp{extension}'
+        try:
+            generate(temp_path)
+            os.replace(temp_path, output_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        _export_cache[kind] = ((fingerprint, output_path), output_path)
+        return output_path
+
+def send_report_from_memory(generate, download_name, mimetype):
+    """Generate a report into memory and send it without writing it to the export folder"""
+    buffer = io.BytesIO()
+    generate(buffer)
+    buffer.seek(0)
+    return send_file(buffer, mimetype=mimetype, as_attachment=True, download_name=download_name)
 
 @app.route('/export/pdf')
 def export_pdf():
     """Export expense report as PDF with receipt images"""
     try:
-        from generators.pdf_generator import ExpensePDFGenerator
-        from datetime import datetime
-
         # Get current month for folder organization
         current_date = datetime.now()
         year_month = f"{current_date.year}_{current_date.month:02d}"
 
+        output_filename = 'expense_report_approval.pdf'
+
+        # ?save=0 downloads the report without keeping a copy on disk
+        if request.args.get('save') == '0':
+            return send_report_from_memory(lambda buffer: ExpensePDFGenerator(db, executor=executor).generate_expense_report(
+                buffer, include_images=True), output_filename, 'application/pdf')
+
         # Get export folder
         export_folder = get_export_folder(year_month)
-        output_filename = 'expense_report_approval.pdf'
         output_path = export_folder / output_filename
 
-        # Generate PDF
-        generator = ExpensePDFGenerator()
-        pdf_filename = generator.generate_expense_report(str(output_path), include_images=True)
+        # Generate PDF, or reuse the last one if nothing changed
+        pdf_filename = get_cached_export('pdf', output_path, lambda path: ExpensePDFGenerator(db, executor=executor)
+                                         .generate_expense_report(path, include_images=True))
 
         # Send file for download
-        response = send_file(pdf_filename, as_attachment=True, download_name=output_filename)
+        response = send_report_file(pdf_filename, output_filename)
 
         flash(f'✅ PDF report saved to: {export_folder}')
         return response
@@ -199,24 +442,27 @@ def export_pdf():
 def export_pdf_summary():
     """Export expense report as PDF summary only (no images)"""
     try:
-        from generators.pdf_generator import ExpensePDFGenerator
-        from datetime import datetime
-
         # Get current month for folder organization
         current_date = datetime.now()
         year_month = f"{current_date.year}_{current_date.month:02d}"
 
+        output_filename = 'expense_summary.pdf'
+
+        # ?save=0 downloads the report without keeping a copy on disk
+        if request.args.get('save') == '0':
+            return send_report_from_memory(lambda buffer: ExpensePDFGenerator(db).generate_expense_report(
+                buffer, include_images=False), output_filename, 'application/pdf')
+
         # Get export folder
         export_folder = get_export_folder(year_month)
-        output_filename = 'expense_summary.pdf'
         output_path = export_folder / output_filename
 
-        # Generate PDF
-        generator = ExpensePDFGenerator()
-        pdf_filename = generator.generate_expense_report(str(output_path), include_images=False)
+        # Generate PDF, or reuse the last one if nothing changed
+        pdf_filename = get_cached_export('pdf-summary', output_path, lambda path: ExpensePDFGenerator(db)
+                                         .generate_expense_report(path, include_images=False))
 
         # Send file for download
-        response = send_file(pdf_filename, as_attachment=True, download_name=output_filename)
+        response = send_report_file(pdf_filename, output_filename)
 
         flash(f'✅ PDF summary saved to: {export_folder}')
         return response
@@ -232,24 +478,27 @@ def export_pdf_summary():
 def export_excel():
     """Export expense report as Excel file matching company format"""
     try:
-        from generators.excel_generator import ExcelExpenseGenerator
-        from datetime import datetime
-
         # Create Excel filename with current month
         current_date = datetime.now()
         year_month = f"{current_date.year}_{current_date.month:02d}"
         output_filename = f"{year_month}_Gastos_MX.xlsx"
 
+        # ?save=0 downloads the report without keeping a copy on disk
+        if request.args.get('save') == '0':
+            return send_report_from_memory(lambda buffer: ExcelExpenseGenerator(db).generate_monthly_report(buffer),
+                                           output_filename,
+                                           'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
         # Get export folder
         export_folder = get_export_folder(year_month)
         output_path = export_folder / output_filename
 
-        # Generate Excel
-        generator = ExcelExpenseGenerator()
-        excel_filename = generator.generate_monthly_report(str(output_path))
+        # Generate Excel, or reuse the last one if nothing changed
+        excel_filename = get_cached_export('excel', output_path, lambda path: ExcelExpenseGenerator(db)
+                                           .generate_monthly_report(path))
 
         # Send file for download
-        response = send_file(excel_filename, as_attachment=True, download_name=output_filename)
+        response = send_report_file(excel_filename, output_filename)
 
         flash(f'✅ Excel report saved to: {export_folder}')
         return response
@@ -266,15 +515,23 @@ def delete_receipt_route(receipt_id):
     """Delete a receipt"""
     receipt = db.get_receipt(receipt_id)
     if receipt:
-        # Delete file if it exists
-        if os.path.exists(receipt['file_path']):
-            os.remove(receipt['file_path'])
-        
         # Delete from database
         if db.delete_receipt(receipt_id):
             flash('Receipt deleted successfully')
         else:
             flash('Error deleting receipt')
+        
+        # Delete the thumbnail, and the file with its copies cached for PDF reports
+        # unless another cost-center split still points at it. Its OCR and AI
+        # results are forgotten while the file can still be hashed.
+        file_path = receipt['file_path']
+        if file_path and os.path.abspath(file_path) not in referenced_file_paths():
+            if os.path.exists(file_path):
+                reader.forget_file(file_path)
+                os.remove(file_path)
+            ExpensePDFGenerator.purge_cached_images(file_path)
+        if os.path.exists(thumbnail_path(receipt_id)):
+            os.remove(thumbnail_path(receipt_id))
     else:
         flash('Receipt not found')
     
@@ -282,18 +539,18 @@ def delete_receipt_route(receipt_id):
 
 @app.route('/export/organized-files')
 def export_organized_files():
-    """Export all reviewed receipts as organized PDFs to Downloads/Expense_Receipts folder"""
+    """Export all reviewed receipts as organized PDFs to Downloads/Expense_Receipts folder; ?combined=1 writes one PDF"""
     try:
         # Get all reviewed receipts
-        receipts = db.get_all_receipts()
-        reviewed_receipts = [r for r in receipts if r.get('reviewed')]
+        reviewed_receipts = db.get_receipts_for_export()
 
         if not reviewed_receipts:
             flash('No reviewed receipts to export. Please review receipts first.')
             return redirect(url_for('index'))
 
         # Export organized files
-        result = export_organized_receipts(reviewed_receipts, db)
+        result = export_organized_receipts(reviewed_receipts, db, executor=executor,
+                                           combined=request.args.get('combined') == '1')
 
         if result['success']:
             exported = result['exported_count']
@@ -317,8 +574,11 @@ def export_organized_files():
 def get_reembolso_suggestions():
     """Get remembered reembolso suggestions for autocomplete"""
     try:
-        suggestions = db.get_remembered_categories('reembolso')
-        return jsonify(suggestions)
+        cached = _suggestions_cache.get('reembolso')
+        if cached is None or time.monotonic() - cached[0] > SUGGESTIONS_TTL:
+            cached = (time.monotonic(), orjson.dumps(db.get_remembered_categories('reembolso')))
+            _suggestions_cache['reembolso'] = cached
+        return Response(cached[1], mimetype='application/json')
     except Exception as e:
         return jsonify([])
 
@@ -385,6 +645,9 @@ def clear_all_receipts():
     """Clear all receipts from the database"""
     try:
         deleted_records, deleted_files = db.clear_all_receipts()
+        shutil.rmtree(THUMBNAIL_DIR, ignore_errors=True)
+        shutil.rmtree(ExpensePDFGenerator.IMAGE_CACHE_DIR, ignore_errors=True)
+        reader.clear_cache()
         return jsonify({
             'success': True,
             'deleted_records': deleted_records,
@@ -394,10 +657,36 @@ def clear_all_receipts():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'pdf'})
+_ALLOWED_SUFFIXES = tuple('.' + ext for ext in ALLOWED_EXTENSIONS)
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'pdf'}
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return filename.lower().endswith(_ALLOWED_SUFFIXES)
+
+# Currency symbols/codes and whitespace that may surround a typed amount
+_NUM_STRIP_RE = re.compile(r"[\s$€£']|MXN|USD|EUR", re.IGNORECASE)
+_THOUSANDS_RE = re.compile(r'[-+]?\d{1,3}(?:,\d{3})+')
+
+def parse_number(value):
+    """Parse a form number such as '$1,234.56' or '1.234,56', returning None for blank input"""
+    if not value or not value.strip():
+        return None
+    text = _NUM_STRIP_RE.sub('', value)
+    if ',' in text and '.' in text:
+        # Whichever separator comes last is the decimal point
+        if text.rfind(',') > text.rfind('.'):
+            text = text.replace('.', '').replace(',', '.')
+        else:
+            text = text.replace(',', '')
+    elif ',' in text:
+        # '1,234' groups thousands, '12,5' is a decimal comma
+        text = text.replace(',', '' if _THOUSANDS_RE.fullmatch(text) else '.')
+    # float() raises ValueError for anything still not a number, e.g. '12-5'
+    number = float(text)
+    if not math.isfinite(number):
+        raise ValueError(f'Invalid number: {value!r}')
+    return number
 
 if __name__ == '__main__':
     app.run(debug=True, host='127.0.0.1', port=8080)
\ No newline at end of file
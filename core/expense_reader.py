@@ -6,28 +6,158 @@ from dotenv import load_dotenv
 import pandas as pd
 from datetime import datetime
 import json
-import PyPDF2
+import hashlib
+import sqlite3
+import threading
+import pypdf
+from concurrent.futures import ThreadPoolExecutor
+
+# tesserocr runs Tesseract in process instead of starting a subprocess per
+# image, but it needs libtesseract to build, so pytesseract remains the fallback
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
 # Load environment variables
 load_dotenv()
 
 class ExpenseReader:
-    def __init__(self):
+    # Bump whenever the extraction prompt changes, so cached AI results are not reused
+    PROMPT_VERSION = 2
+    
+    # Bump whenever image preprocessing or text extraction changes, so cached OCR
+    # text is not reused (the Tesseract languages and config are keyed separately)
+    # 2: pypdf text extraction, 3: downscaled images, 4: tesserocr, 5: sparse text mode and grayscale
+    OCR_VERSION = 5
+    
+    # Longest edge images are scaled down to before OCR. Phone photos are far
+    # larger than Tesseract needs, and its run time grows with the pixel count.
+    OCR_MAX_SIZE = 2000
+    
+    # Receipts are short scattered lines rather than paragraphs, so Tesseract's
+    # sparse text mode (PSM 11) with the LSTM engine suits them best
+    TESSERACT_CONFIG = '--psm 11 --oem 1'
+    
+    def __init__(self, cache_path='data/cache.db', db=None):
         self.client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
         
         # Set Tesseract path if specified
         tesseract_path = os.getenv('TESSERACT_PATH')
         if tesseract_path:
             pytesseract.pytesseract.tesseract_cmd = tesseract_path
+        
+        # OCR text keyed by a hash of the file and AI extraction results keyed by
+        # a hash of the OCR text are kept on disk, so a receipt seen before skips
+        # Tesseract and OpenAI even after a restart
+        self.cache_path = cache_path
+        self._cache_conn = None
+        self._cache_pid = None
+        self._cache_lock = threading.Lock()
+        
+        # tesserocr APIs are not thread safe, so each OCR thread keeps its own
+        self._tess_local = threading.local()
+        self._ocr_lang = None
+        
+        # The few-shot prompt header only changes when a receipt is reviewed, so it
+        # is rendered once and reused, which also lets OpenAI cache the shared prefix
+        self.db = db
+        self._prompt_header = None
+        self._prompt_header_version = None
+    
+    def _get_cache_connection(self):
+        """Get the cache database connection, opening it on first use (call with the lock held)"""
+        if self._cache_conn is None or self._cache_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.cache_path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # source holds the hash of the file or OCR text an entry was made from,
+            # so every entry for a deleted receipt can be found whatever its version
+            for table, column in (('ocr_cache', 'text'), ('llm_cache', 'json')):
+                columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+                if columns and 'source' not in columns:
+                    # Caches from before source was added are keyed differently anyway
+                    conn.execute(f'DROP TABLE {table}')
+                conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (hash TEXT PRIMARY KEY, {column} TEXT, source TEXT)')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_source ON {table}(source)')
+            conn.commit()
+            self._cache_conn = conn
+            self._cache_pid = os.getpid()
+        return self._cache_conn
+    
+    def _cache_get(self, table, key):
+        """Look up a cached value, returning None on a miss"""
+        try:
+            with self._cache_lock:
+                row = self._get_cache_connection().execute(
+                    f'SELECT * FROM {table} WHERE hash = ?', (key,)).fetchone()
+            return row[1] if row else None
+        except sqlite3.Error as e:
+            print(f"Error reading {table}: {e}")
+            return None
+    
+    def _cache_put(self, table, key, value, source):
+        """Store a value in the cache"""
+        try:
+            with self._cache_lock:
+                conn = self._get_cache_connection()
+                with conn:
+                    conn.execute(f'INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)', (key, value, source))
+        except sqlite3.Error as e:
+            print(f"Error writing {table}: {e}")
+    
+    def forget_file(self, file_path):
+        """Drop the cached OCR text and AI results for a file (call before the file is deleted)"""
+        file_hash = self._hash_file(file_path)
+        if not file_hash:
+            return
+        try:
+            with self._cache_lock:
+                conn = self._get_cache_connection()
+                with conn:
+                    texts = [row[0] for row in conn.execute('SELECT text FROM ocr_cache WHERE source = ?', (file_hash,))]
+                    conn.executemany('DELETE FROM llm_cache WHERE source = ?',
+                                     [(self._hash_text(text),) for text in texts])
+                    conn.execute('DELETE FROM ocr_cache WHERE source = ?', (file_hash,))
+        except sqlite3.Error as e:
+            print(f"Error clearing cache for {file_path}: {e}")
+    
+    def clear_cache(self):
+        """Drop every cached OCR text and AI result"""
+        try:
+            with self._cache_lock:
+                conn = self._get_cache_connection()
+                with conn:
+                    conn.execute('DELETE FROM ocr_cache')
+                    conn.execute('DELETE FROM llm_cache')
+        except sqlite3.Error as e:
+            print(f"Error clearing cache: {e}")
+    
+    @staticmethod
+    def _hash_file(file_path):
+        """Hash a file's contents in chunks, or return None if it can't be read"""
+        hasher = hashlib.blake2b()
+        try:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    hasher.update(chunk)
+        except OSError:
+            return None
+        return hasher.hexdigest()
+    
+    @staticmethod
+    def _hash_text(text):
+        """Hash an OCR text, identifying the AI results made from it"""
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
     
     def extract_text_from_pdf(self, pdf_path):
         """Extract text from PDF file"""
         try:
-            text = ""
             with open(pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
+                pdf_reader = pypdf.PdfReader(file)
+                # Join the pages once rather than growing a string page by page
+                text = "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
             return text.strip()
         except Exception as e:
             print(f"Error processing PDF {pdf_path}: {e}")
@@ -37,35 +167,107 @@ class ExpenseReader:
         """Extract text from receipt image using OCR"""
         try:
             image = Image.open(image_path)
-            # Convert to RGB if needed (handles EXIF issues)
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+            # JPEGs can be decoded at a reduced scale, and in grayscale, straight away
+            image.draft('L', (self.OCR_MAX_SIZE, self.OCR_MAX_SIZE))
             # Auto-rotate based on EXIF orientation
             try:
                 from PIL import ImageOps
                 image = ImageOps.exif_transpose(image)
             except:
                 pass
-            ocr_text = pytesseract.image_to_string(image, lang='eng')
+            # Tesseract works on grayscale anyway; this also drops any alpha channel
+            if image.mode != 'L':
+                image = image.convert('L')
+            if max(image.size) > self.OCR_MAX_SIZE:
+                image.thumbnail((self.OCR_MAX_SIZE, self.OCR_MAX_SIZE), Image.LANCZOS)
+            ocr_text = self._run_tesseract(image)
             return ocr_text
         except Exception as e:
             print(f"Error processing image {image_path}: {e}")
             return None
     
+    def _run_tesseract(self, image):
+        """OCR a prepared image, in process when tesserocr is installed"""
+        lang = self._get_ocr_lang()
+        if tesserocr is None:
+            return pytesseract.image_to_string(image, lang=lang, config=self.TESSERACT_CONFIG)
+        
+        api = getattr(self._tess_local, 'api', None)
+        if api is None:
+            # The language model is loaded once per thread and stays warm between images
+            api = self._tess_local.api = tesserocr.PyTessBaseAPI(
+                lang=lang, psm=tesserocr.PSM.SPARSE_TEXT, oem=tesserocr.OEM.LSTM_ONLY)
+        api.SetImage(image)
+        return api.GetUTF8Text()
+    
+    def _get_ocr_lang(self):
+        """Get the Tesseract languages to use, keeping only those that are installed"""
+        if self._ocr_lang is None:
+            # Most receipts are Mexican, so Spanish is read alongside English
+            wanted = os.getenv('TESSERACT_LANG', 'eng+spa').split('+')
+            try:
+                installed = set(tesserocr.get_languages()[1] if tesserocr else pytesseract.get_languages())
+            except Exception:
+                installed = set(wanted)
+            self._ocr_lang = '+'.join(lang for lang in wanted if lang in installed) or 'eng'
+        return self._ocr_lang
+    
+    def _ocr_cache_key(self, file_hash):
+        """Key a file's OCR text in the cache by its contents and the OCR settings"""
+        key = f"{self.OCR_VERSION}\n{self._get_ocr_lang()}\n{self.TESSERACT_CONFIG}\n{file_hash}"
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+    
     def extract_text_from_file(self, file_path):
         """Extract text from either image or PDF file"""
+        file_hash = self._hash_file(file_path)
+        if file_hash:
+            cache_key = self._ocr_cache_key(file_hash)
+            cached_text = self._cache_get('ocr_cache', cache_key)
+            if cached_text is not None:
+                return cached_text
+        
         file_extension = os.path.splitext(file_path)[1].lower()
         
         if file_extension == '.pdf':
-            return self.extract_text_from_pdf(file_path)
+            text = self.extract_text_from_pdf(file_path)
         else:
             # Assume it's an image file
-            return self.extract_text_from_image(file_path)
-    
-    def extract_receipt_data(self, ocr_text, use_training_examples=True):
-        """Use OpenAI to extract structured data from OCR text with few-shot learning"""
+            text = self.extract_text_from_image(file_path)
         
-        # Build prompt with training examples from previous corrections
+        if file_hash and text:
+            self._cache_put('ocr_cache', cache_key, text, file_hash)
+        return text
+    
+    def extract_text_from_files(self, file_paths, executor=None):
+        """Extract text from several files in one call, in parallel when given an executor"""
+        # Tesseract runs as one subprocess per image, so the batch is spread
+        # across workers rather than stacked into a single model call
+        map_func = executor.map if executor else map
+        return list(map_func(self.extract_text_from_file, file_paths))
+    
+    def _extraction_cache_key(self, ocr_text, use_training_examples, examples_version):
+        """Key an OCR text's AI extraction result in the cache by everything that goes into its prompt"""
+        key = f"{self.PROMPT_VERSION}\n{use_training_examples}\n{examples_version}\n{ocr_text}"
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+    
+    def _get_database(self):
+        """Get the database training examples come from, opening the default one for standalone use"""
+        if self.db is None:
+            from app.database import ExpenseDatabase
+            self.db = ExpenseDatabase()
+        return self.db
+    
+    def _get_examples_version(self, use_training_examples):
+        """Get the version of the training examples a prompt would include, or None without them"""
+        if not use_training_examples:
+            return None
+        try:
+            return self._get_database().get_training_examples_version()
+        except Exception:
+            return None
+    
+    def _build_prompt_header(self, use_training_examples):
+        """Start an extraction prompt, with training examples from previous corrections"""
         prompt = """You are an AI assistant that extracts structured information from receipts.
 
 Here are some examples of correctly extracted data from similar receipts:
@@ -75,8 +277,13 @@ Here are some examples of correctly extracted data from similar receipts:
         # Add training examples if available and requested
         if use_training_examples:
             try:
-                from app.database import ExpenseDatabase
-                db = ExpenseDatabase()
+                db = self._get_database()
+                
+                # Re-render only when a reviewed receipt has changed since last time
+                version = db.get_training_examples_version()
+                if self._prompt_header is not None and version == self._prompt_header_version:
+                    return self._prompt_header
+                
                 examples = db.get_training_examples(limit=3)
                 
                 for i, example in enumerate(examples, 1):
@@ -86,10 +293,37 @@ Correct extraction:
 {{"restaurant_name": "{example['restaurant_name']}", "date": "{example['date']}", "total_amount": {example['total_amount']}}}
 
 """
+                self._prompt_header, self._prompt_header_version = prompt, version
             except Exception as e:
                 # If database isn't available, continue without examples
                 pass
         
+        return prompt
+    
+    def _request_json(self, prompt):
+        """Send a prompt to OpenAI and parse the JSON object it returns"""
+        response = self.client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+            # JSON mode always returns a bare JSON object, never a markdown fence
+            response_format={"type": "json_object"}
+        )
+        data = json.loads(response.choices[0].message.content)
+        if not isinstance(data, dict):
+            raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+        return data
+    
+    def extract_receipt_data(self, ocr_text, use_training_examples=True):
+        """Use OpenAI to extract structured data from OCR text with few-shot learning"""
+        cache_key = self._extraction_cache_key(
+            ocr_text, use_training_examples, self._get_examples_version(use_training_examples))
+        cached_json = self._cache_get('llm_cache', cache_key)
+        cached_data = json.loads(cached_json) if cached_json is not None else None
+        if isinstance(cached_data, dict):
+            return cached_data
+        
+        prompt = self._build_prompt_header(use_training_examples)
         prompt += f"""
 Now extract data from this new receipt:
 
@@ -106,26 +340,83 @@ Learn from the examples above to be more accurate. If any information is not fou
 """
 
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0
-            )
-            
-            # Parse the JSON response
-            result_text = response.choices[0].message.content
-            # Extract JSON from the response (in case it's wrapped in markdown)
-            if "```json" in result_text:
-                json_start = result_text.find("```json") + 7
-                json_end = result_text.find("```", json_start)
-                result_text = result_text[json_start:json_end].strip()
-            
-            return json.loads(result_text)
+            receipt_data = self._request_json(prompt)
+            self._cache_put('llm_cache', cache_key, json.dumps(receipt_data), self._hash_text(ocr_text))
+            return receipt_data
             
         except Exception as e:
             print(f"Error extracting data with OpenAI: {e}")
             return None
     
+    def extract_receipt_data_batch(self, ocr_texts, use_training_examples=True, batch_size=20, executor=None):
+        """Extract structured data from several OCR texts with one OpenAI request per batch"""
+        results = [None] * len(ocr_texts)
+        examples_version = self._get_examples_version(use_training_examples)
+        
+        # Cached texts are answered right away and empty texts stay None; the
+        # rest are grouped by text so a repeated receipt is only sent once
+        pending = {}
+        for index, ocr_text in enumerate(ocr_texts):
+            if not ocr_text:
+                continue
+            if ocr_text in pending:
+                pending[ocr_text].append(index)
+                continue
+            cached_json = self._cache_get(
+                'llm_cache', self._extraction_cache_key(ocr_text, use_training_examples, examples_version))
+            cached_data = json.loads(cached_json) if cached_json is not None else None
+            if isinstance(cached_data, dict):
+                results[index] = cached_data
+            else:
+                pending[ocr_text] = [index]
+        if not pending:
+            return results
+        
+        # The few-shot header is shared by every batch
+        header = self._build_prompt_header(use_training_examples)
+        pending_texts = list(pending)
+        batches = [pending_texts[i:i + batch_size] for i in range(0, len(pending_texts), batch_size)]
+        
+        def run_batch(texts):
+            if len(texts) == 1:
+                return [self.extract_receipt_data(texts[0], use_training_examples)]
+            
+            receipts_text = "\n".join(
+                f"Receipt {n}:\n---\n{ocr_text}\n---\n" for n, ocr_text in enumerate(texts, 1))
+            prompt = header + f"""
+Now extract data from each of these {len(texts)} new receipts:
+
+{receipts_text}
+Please return a JSON object with a "receipts" key holding one object per receipt, in the same order, each with these exact keys:
+- "restaurant_name": The name of the restaurant/venue (be consistent with naming)
+- "date": The date of purchase (format: YYYY-MM-DD)
+- "total_amount": The total amount paid including tip (just the number, no currency symbol)
+
+Learn from the examples above to be more accurate. If any information is not found, use null for that field.
+"""
+            try:
+                batch_data = self._request_json(prompt).get('receipts')
+                # Only a full list of receipt objects is trusted (and cached)
+                if (isinstance(batch_data, list) and len(batch_data) == len(texts) and
+                        all(isinstance(receipt_data, dict) for receipt_data in batch_data)):
+                    for ocr_text, receipt_data in zip(texts, batch_data):
+                        cache_key = self._extraction_cache_key(ocr_text, use_training_examples, examples_version)
+                        self._cache_put('llm_cache', cache_key, json.dumps(receipt_data), self._hash_text(ocr_text))
+                    return batch_data
+                print(f"OpenAI returned a malformed batch for {len(texts)} receipts, retrying one by one")
+            except Exception as e:
+                print(f"Error extracting batch data with OpenAI: {e}")
+            # Fall back to one request per receipt so a bad batch doesn't lose them all
+            return [self.extract_receipt_data(ocr_text, use_training_examples) for ocr_text in texts]
+        
+        map_func = executor.map if executor else map
+        for texts, batch_data in zip(batches, map_func(run_batch, batches)):
+            for ocr_text, receipt_data in zip(texts, batch_data):
+                for index in pending[ocr_text]:
+                    # Each receipt gets its own copy, since callers add fields to it
+                    results[index] = dict(receipt_data) if receipt_data else receipt_data
+        return results
+    
     def process_single_receipt(self, file_path):
         """Process a single receipt file (image or PDF) and return extracted data"""
         print(f"Processing: {file_path}")
@@ -150,16 +441,23 @@ Learn from the examples above to be more accurate. If any information is not fou
     
     def process_receipts_folder(self, folder_path):
         """Process all receipt files (images and PDFs) in a folder"""
-        results = []
-        supported_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.pdf']
+        supported_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.pdf')
+        file_paths = [os.path.join(folder_path, filename) for filename in os.listdir(folder_path)
+                      if filename.lower().endswith(supported_extensions)]
         
-        for filename in os.listdir(folder_path):
-            if any(filename.lower().endswith(ext) for ext in supported_extensions):
-                file_path = os.path.join(folder_path, filename)
-                receipt_data = self.process_single_receipt(file_path)
-                if receipt_data:
-                    results.append(receipt_data)
+        # OCR runs in parallel, then the texts go to OpenAI in batches;
+        # results keep the folder listing order
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            extracted_texts = self.extract_text_from_files(file_paths, executor=executor)
+            receipt_data_list = self.extract_receipt_data_batch(extracted_texts, executor=executor)
         
+        results = []
+        processed_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for file_path, receipt_data in zip(file_paths, receipt_data_list):
+            if receipt_data:
+                receipt_data['file_name'] = os.path.basename(file_path)
+                receipt_data['processed_date'] = processed_date
+                results.append(receipt_data)
         return results
     
     def save_to_csv(self, results, output_file="expense_report.csv"):
@@ -1,16 +1,35 @@
 """
 Utility functions for file handling, sanitization, and PDF conversion
 """
+import io
 import os
 import re
+import shutil
 import unicodedata
+from functools import lru_cache
 from pathlib import Path
-from PIL import Image
+from PIL import Image, ImageOps
+from pypdf import PdfReader, PdfWriter
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.utils import ImageReader
 
+# Runs of anything that isn't a filename word character; a run containing a
+# space or hyphen becomes a single underscore, anything else is dropped.
+_NON_WORD_RUN_RE = re.compile(r'[^A-Za-z0-9_]+')
+_SEPARATOR_CHARS = frozenset(' \t\n\r\f\v-')
 
+# Longest side, in pixels, of receipt images embedded in exported PDFs
+# (about 250 dpi on a letter page)
+PDF_IMAGE_MAX_SIZE = 2000
+
+
+def _replace_non_word_run(match):
+    return '' if _SEPARATOR_CHARS.isdisjoint(match.group()) else '_'
+
+
+# The same few restaurants come up receipt after receipt
+@lru_cache(maxsize=1024)
 def sanitize_filename(text):
     """
     Sanitize text for use in filenames.
@@ -24,14 +43,15 @@ def sanitize_filename(text):
     if not text:
         return "Unknown"
 
-    # Remove accents: Café -> Cafe
-    text = unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore').decode('ASCII')
-
-    # Remove special characters, keep alphanumeric, spaces, hyphens, underscores
-    text = re.sub(r'[^\w\s-]', '', text)
+    # Remove accents: Café -> Cafe (plain ASCII names need no folding)
+    if not text.isascii():
+        if not unicodedata.is_normalized('NFKD', text):
+            text = unicodedata.normalize('NFKD', text)
+        text = text.encode('ASCII', 'ignore').decode('ASCII')
 
-    # Replace multiple spaces/hyphens with single underscore
-    text = re.sub(r'[-\s]+', '_', text)
+    # Remove special characters and replace runs of spaces/hyphens with a
+    # single underscore, in one pass
+    text = _NON_WORD_RUN_RE.sub(_replace_non_word_run, text)
 
     # Remove leading/trailing underscores
     text = text.strip('_')
@@ -39,6 +59,7 @@ def sanitize_filename(text):
     return text if text else "Unknown"
 
 
+@lru_cache(maxsize=1024)
 def format_receipt_filename(date, restaurant_name):
     """
     Format receipt filename according to yyyy_mm_RestaurantName pattern.
@@ -66,39 +87,6 @@ def format_receipt_filename(date, restaurant_name):
     return f"{year_month}_{sanitized_name}"
 
 
-def add_display_filenames_to_receipts(receipts):
-    """
-    Add display_filename field to each receipt with duplicate handling.
-    Modifies receipts list in-place, adding 'display_filename' field.
-
-    Args:
-        receipts: List of receipt dictionaries
-
-    Returns:
-        None (modifies receipts in-place)
-    """
-    seen_filenames = {}
-
-    for receipt in receipts:
-        if receipt.get('reviewed') and receipt.get('date') and receipt.get('restaurant_name'):
-            formatted_name = format_receipt_filename(receipt['date'], receipt['restaurant_name'])
-
-            if formatted_name:
-                # Check if we've seen this filename before
-                if formatted_name in seen_filenames:
-                    seen_filenames[formatted_name] += 1
-                    display_name = f"{formatted_name}_{seen_filenames[formatted_name]}.pdf"
-                else:
-                    seen_filenames[formatted_name] = 1
-                    display_name = f"{formatted_name}.pdf"
-
-                receipt['display_filename'] = display_name
-            else:
-                receipt['display_filename'] = receipt['filename']
-        else:
-            receipt['display_filename'] = receipt['filename']
-
-
 def get_export_folder(year_month=None):
     """
     Get the export folder path, creating it if necessary.
@@ -122,7 +110,7 @@ def get_export_folder(year_month=None):
     return export_folder
 
 
-def get_unique_filename(folder, base_name, extension):
+def get_unique_filename(folder, base_name, extension, taken=None):
     """
     Generate a unique filename by adding _2, _3, etc. if file exists.
 
@@ -130,86 +118,162 @@ def get_unique_filename(folder, base_name, extension):
         folder: Path object for destination folder
         base_name: Base filename without extension
         extension: File extension (e.g., ".pdf")
+        taken: Optional set of filenames already in the folder or claimed but
+            not yet written; the returned name is added to it. If omitted,
+            the folder is listed once.
 
     Returns:
         Unique filename string
     """
-    filename = f"{base_name}{extension}"
-    filepath = folder / filename
-
-    if not filepath.exists():
-        return filename
+    if taken is None:
+        try:
+            taken = {entry.name for entry in os.scandir(folder)}
+        except FileNotFoundError:
+            taken = set()
 
-    # File exists, add counter
+    filename = f"{base_name}{extension}"
     counter = 2
-    while True:
+    while filename in taken:
         filename = f"{base_name}_{counter}{extension}"
-        filepath = folder / filename
-        if not filepath.exists():
-            return filename
         counter += 1
 
+    taken.add(filename)
+    return filename
 
-def convert_image_to_pdf(image_path, output_path):
+
+def create_thumbnail(image_path, thumb_path, size=(256, 256)):
     """
-    Convert an image file to PDF format using ReportLab.
-    Maintains aspect ratio and fits to letter size page.
+    Save a small JPEG preview of a receipt image for the dashboard.
 
     Args:
         image_path: Path to source image file
-        output_path: Path for output PDF file
+        thumb_path: Path for output JPEG thumbnail
+        size: Maximum (width, height) of the thumbnail
 
     Returns:
         True if successful, False otherwise
     """
     try:
-        # If already a PDF, just copy it
-        if str(image_path).lower().endswith('.pdf'):
-            import shutil
-            shutil.copy(image_path, output_path)
-            return True
+        with Image.open(image_path) as img:
+            # Let the JPEG decoder downscale while loading instead of decoding full size
+            img.draft('RGB', size)
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.thumbnail(size)
+
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            img.save(thumb_path, 'JPEG', quality=75, optimize=True)
+        return True
+
+    except Exception as e:
+        print(f"Error creating thumbnail for {image_path}: {e}")
+        return False
+
+
+def _load_pdf_image(image_path):
+    """
+    Open a receipt image and prepare it for drawing on a PDF page.
 
-        # Open image with PIL to get dimensions
-        img = Image.open(image_path)
+    Args:
+        image_path: Path to source image file
+
+    Returns:
+        Tuple of (ImageReader, width, height)
+    """
+    with Image.open(image_path) as img:
+        # Embed photos as JPEG rather than ReportLab's zlib-compressed raw
+        # pixels. JPEGs that are already small enough go in unchanged, without
+        # being decoded here at all.
+        upright = img.getexif().get(0x0112, 1) == 1
+        if img.format == 'JPEG' and img.mode in ('RGB', 'L') and max(img.size) <= PDF_IMAGE_MAX_SIZE and upright:
+            return (ImageReader(str(image_path)), *img.size)
+
+        # Decode now so the file is read in one go and closed on leaving the block,
+        # turning phone photos upright from their EXIF orientation
+        img.load()
+        img = ImageOps.exif_transpose(img)
+
+        # Flatten transparency onto white (for JPEG compatibility); RGB and L
+        # images are drawn as they are
+        if img.mode == 'P':
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        if img.mode in ('RGBA', 'LA'):
+            alpha = img.getchannel('A')
+            if alpha.getextrema()[0] < 255:
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=alpha)
+                img = background
+            else:
+                img = img.convert('RGB' if img.mode == 'RGBA' else 'L')
 
-        # Convert RGBA to RGB if necessary (for JPEG compatibility)
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-            img = background
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.thumbnail((PDF_IMAGE_MAX_SIZE, PDF_IMAGE_MAX_SIZE), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=85)
+        buffer.seek(0)
 
         img_width, img_height = img.size
+        return ImageReader(buffer), img_width, img_height
 
-        # Create PDF with letter size
-        page_width, page_height = letter
 
-        # Calculate scaling to fit image on page with margins
-        margin = 36  # 0.5 inch margins
-        max_width = page_width - (2 * margin)
-        max_height = page_height - (2 * margin)
+def _draw_pdf_page(c, image, img_width, img_height):
+    """
+    Draw an image centered on the current letter size page, keeping its aspect ratio.
 
-        # Calculate aspect ratio scaling
-        width_ratio = max_width / img_width
-        height_ratio = max_height / img_height
-        scale = min(width_ratio, height_ratio)
+    Args:
+        c: ReportLab canvas
+        image: ImageReader for the image
+        img_width: Image width in pixels
+        img_height: Image height in pixels
+    """
+    page_width, page_height = letter
 
-        # New dimensions
-        new_width = img_width * scale
-        new_height = img_height * scale
+    # Calculate scaling to fit image on page with margins
+    margin = 36  # 0.5 inch margins
+    max_width = page_width - (2 * margin)
+    max_height = page_height - (2 * margin)
 
-        # Center on page
-        x = (page_width - new_width) / 2
-        y = (page_height - new_height) / 2
+    # Calculate aspect ratio scaling
+    width_ratio = max_width / img_width
+    height_ratio = max_height / img_height
+    scale = min(width_ratio, height_ratio)
 
-        # Create PDF
-        c = canvas.Canvas(str(output_path), pagesize=letter)
+    # New dimensions
+    new_width = img_width * scale
+    new_height = img_height * scale
 
-        # Draw image
-        c.drawImage(ImageReader(img), x, y, width=new_width, height=new_height)
+    # Center on page
+    x = (page_width - new_width) / 2
+    y = (page_height - new_height) / 2
 
-        # Save PDF
+    c.drawImage(image, x, y, width=new_width, height=new_height)
+
+
+def convert_image_to_pdf(image_path, output_path):
+    """
+    Convert an image file to PDF format using ReportLab.
+    Maintains aspect ratio and fits to letter size page.
+
+    Args:
+        image_path: Path to source image file
+        output_path: Path for output PDF file
+
+    Returns:
+        True if successful, False otherwise
+    """
+    try:
+        # If already a PDF, just copy it
+        if str(image_path).lower().endswith('.pdf'):
+            shutil.copyfile(image_path, output_path)
+            return True
+
+        image = _load_pdf_image(image_path)
+
+        # Create PDF with letter size
+        c = canvas.Canvas(str(output_path), pagesize=letter)
+        _draw_pdf_page(c, *image)
         c.save()
 
         return True
@@ -219,13 +283,87 @@ def convert_image_to_pdf(image_path, output_path):
         return False
 
 
-def export_organized_receipts(receipts, db):
+def _try_load_pdf_image(image_path):
+    """Load an image for a PDF page, or return None if it can't be read"""
+    try:
+        return _load_pdf_image(image_path)
+    except Exception as e:
+        print(f"Error converting {image_path} to PDF: {e}")
+        return None
+
+
+def combine_images_to_pdf(image_paths, output_path, executor=None):
+    """
+    Write several receipt files into a single PDF, one page per image.
+    Receipts that are already PDFs contribute all of their pages.
+
+    Args:
+        image_paths: Paths to source image or PDF files, in page order
+        output_path: Path for output PDF file
+        executor: Optional executor to prepare the images concurrently
+
+    Returns:
+        List with True for each input that was included, False otherwise
+    """
+    is_pdf = [str(path).lower().endswith('.pdf') for path in image_paths]
+    image_only = [path for path, pdf in zip(image_paths, is_pdf) if not pdf]
+    if executor is not None:
+        images = list(executor.map(_try_load_pdf_image, image_only))
+    else:
+        images = [_try_load_pdf_image(path) for path in image_only]
+
+    # Nothing would end up in the PDF, so don't leave an empty one behind
+    if not any(is_pdf) and not any(images):
+        return [False] * len(images)
+
+    # Every image goes on one canvas, so the PDF is written once
+    pages = io.BytesIO() if any(is_pdf) else str(output_path)
+    c = canvas.Canvas(pages, pagesize=letter)
+    for image in images:
+        if image:
+            _draw_pdf_page(c, *image)
+            c.showPage()
+    c.save()
+
+    if not any(is_pdf):
+        return [image is not None for image in images]
+
+    # Splice the PDF receipts in between the image pages, in order
+    writer = PdfWriter()
+    drawn_pages = iter(PdfReader(pages).pages)
+    images = iter(images)
+    included = []
+    for path, pdf in zip(image_paths, is_pdf):
+        if pdf:
+            try:
+                writer.append(str(path))
+                included.append(True)
+            except Exception as e:
+                print(f"Error adding {path} to PDF: {e}")
+                included.append(False)
+        elif next(images):
+            writer.add_page(next(drawn_pages))
+            included.append(True)
+        else:
+            included.append(False)
+
+    if not any(included):
+        return included
+    with open(output_path, 'wb') as f:
+        writer.write(f)
+    return included
+
+
+def export_organized_receipts(receipts, db, executor=None, combined=False):
     """
     Export all reviewed receipts as organized PDFs to Downloads folder.
 
     Args:
         receipts: List of receipt dictionaries
         db: ExpenseDatabase instance
+        executor: Optional executor to convert the receipts concurrently
+        combined: Write every receipt into one multi-page PDF instead of
+            one PDF per receipt in month folders
 
     Returns:
         Dictionary with success status, folder path, and stats
@@ -233,6 +371,10 @@ def export_organized_receipts(receipts, db):
     try:
         exported_files = []
         skipped_files = []
+        base_folder = get_export_folder()
+        # Names in each month folder, listed once and extended as names are claimed
+        folder_names = {}
+        jobs = []
 
         for receipt in receipts:
             if not receipt.get('reviewed'):
@@ -258,29 +400,55 @@ def export_organized_receipts(receipts, db):
                 skipped_files.append(f"Invalid date/name: {receipt.get('filename', 'Unknown')}")
                 continue
 
+            if combined:
+                jobs.append((receipt, source_path, None))
+                continue
+
             # Get year_month for subfolder (e.g., "2025_10")
             year_month = date[:7].replace('-', '_')
 
-            # Get export folder
-            export_folder = get_export_folder(year_month)
+            # Get export folder, creating and listing each month's folder only once
+            export_folder = base_folder / year_month
+            if year_month not in folder_names:
+                export_folder.mkdir(exist_ok=True)
+                folder_names[year_month] = {entry.name for entry in os.scandir(export_folder)}
 
             # Get unique filename
-            output_filename = get_unique_filename(export_folder, base_name, '.pdf')
-            output_path = export_folder / output_filename
-
-            # Convert to PDF
-            if convert_image_to_pdf(source_path, output_path):
-                exported_files.append(str(output_path))
+            output_filename = get_unique_filename(export_folder, base_name, '.pdf', folder_names[year_month])
+            jobs.append((receipt, source_path, export_folder / output_filename))
+
+        # Convert to PDF
+        sources = [source_path for _, source_path, _ in jobs]
+        if combined:
+            exported_count = 0
+            results = []
+            if jobs:
+                output_path = base_folder / get_unique_filename(base_folder, 'All_Receipts', '.pdf')
+                results = combine_images_to_pdf(sources, output_path, executor)
+                exported_count = sum(results)
+                if exported_count:
+                    exported_files.append(str(output_path))
+        else:
+            outputs = [output_path for _, _, output_path in jobs]
+            if executor is not None:
+                results = executor.map(convert_image_to_pdf, sources, outputs)
             else:
+                results = map(convert_image_to_pdf, sources, outputs)
+            results = list(results)
+            exported_count = sum(results)
+            exported_files.extend(str(output_path) for output_path, converted in zip(outputs, results) if converted)
+
+        for (receipt, _, _), converted in zip(jobs, results):
+            if not converted:
                 skipped_files.append(f"Conversion failed: {receipt.get('filename', 'Unknown')}")
 
         return {
             'success': True,
-            'exported_count': len(exported_files),
+            'exported_count': exported_count,
             'skipped_count': len(skipped_files),
             'exported_files': exported_files,
             'skipped_files': skipped_files,
-            'folder': str(get_export_folder())
+            'folder': str(base_folder)
         }
 
     except Exception as e:
@@ -0,0 +1,7 @@
+def receipt_amount_usd(receipt):
+    """Get a receipt's USD amount, falling back to converting its MXN total with the markup"""
+    amount_usd = receipt.get('amount_mxn')  # This field stores USD amount
+    if not amount_usd and receipt.get('total_amount') and receipt.get('fx_rate'):
+        markup = receipt.get('markup_percent', 2.5)
+        amount_usd = receipt['total_amount'] / receipt['fx_rate'] * (1 + markup / 100)
+    return amount_usd
@@ -1,17 +1,20 @@
-import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment, NamedStyle
+from openpyxl.utils import get_column_letter
 from app.database import ExpenseDatabase
+from generators.amounts import receipt_amount_usd
 from datetime import datetime
-import os
 
 class ExcelExpenseGenerator:
-    def __init__(self):
-        self.db = ExpenseDatabase()
+    def __init__(self, db=None):
+        self.db = db or ExpenseDatabase()
     
     def generate_monthly_report(self, output_filename=None):
-        """Generate Excel report matching your company format"""
+        """Generate Excel report matching your company format (to a path or a file-like object)"""
         
         # Get all reviewed receipts
-        receipts = [r for r in self.db.get_all_receipts() if r['reviewed']]
+        receipts = self.db.get_receipts_for_export()
         
         if not receipts:
             raise ValueError("No reviewed receipts found. Please review receipts in the web interface first.")
@@ -20,29 +23,17 @@ class ExcelExpenseGenerator:
         data = []
         for receipt in receipts:
             # Calculate USD amount (receipts are in MXN, convert to USD)
-            amount_usd = receipt.get('amount_mxn')  # This field actually stores USD
-            if not amount_usd and receipt.get('total_amount') and receipt.get('fx_rate'):
-                markup = receipt.get('markup_percent', 2.5)
-                # total_amount is in MXN, convert to USD with markup
-                usd_base = receipt['total_amount'] / receipt['fx_rate']
-                amount_usd = usd_base * (1 + markup / 100)
-            
-            # Format date for filename if available
-            formatted_filename = receipt['filename']
-            if receipt.get('date') and receipt.get('restaurant_name'):
-                from core.filename_utils import format_receipt_filename
-                new_filename = format_receipt_filename(receipt['date'], receipt['restaurant_name'])
-                if new_filename:
-                    formatted_filename = new_filename
+            amount_usd = receipt_amount_usd(receipt)
             
             # Format date as DD/MM/YYYY
             formatted_date = ''
-            if receipt.get('date'):
-                try:
-                    date_obj = datetime.strptime(receipt['date'], '%Y-%m-%d')
-                    formatted_date = date_obj.strftime('%d/%m/%Y')
-                except:
-                    formatted_date = receipt['date']  # Fallback to original format
+            date = receipt.get('date')
+            if date:
+                # Dates are stored as YYYY-MM-DD, so the parts can be sliced out directly
+                if len(date) == 10 and date[4] == date[7] == '-' and date.replace('-', '').isdigit():
+                    formatted_date = f"{date[8:10]}/{date[5:7]}/{date[0:4]}"
+                else:
+                    formatted_date = date  # Fallback to original format
             
             row = {
                 'Fecha': formatted_date,
@@ -56,65 +47,56 @@ class ExcelExpenseGenerator:
             }
             data.append(row)
         
-        # Create DataFrame with specific column order
+        # Specific column order for the sheet
         column_order = ['Fecha', 'Proveedor', 'Detalle', 'Monto', 'Reembolso', 'Cuenta contable', 'Pais', 'CC']
-        df = pd.DataFrame(data, columns=column_order)
+        rows = [tuple(row[column] for column in column_order) for row in data]
         
         # Generate filename if not provided
         if not output_filename:
             current_date = datetime.now()
             output_filename = f"{current_date.year}_{current_date.month:02d}_Gastos_MX.xlsx"
         
-        # Write to Excel with formatting
-        with pd.ExcelWriter(output_filename, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Gastos', index=False)
-            
-            # Get the workbook and worksheet
-            workbook = writer.book
-            worksheet = writer.sheets['Gastos']
-            
-            # Auto-adjust column widths
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            # Add some basic formatting
-            from openpyxl.styles import Font, PatternFill, Alignment
-            
-            # Header formatting
-            header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-            header_font = Font(color="FFFFFF", bold=True)
-            
-            for cell in worksheet[1]:
-                cell.fill = header_fill
-                cell.font = header_font
-                cell.alignment = Alignment(horizontal="center")
-            
-            # Number formatting for amounts
-            for row in worksheet.iter_rows(min_row=2):
-                # Monto column (column F)
-                if row[5].value and isinstance(row[5].value, (int, float)):
-                    row[5].number_format = '#,##0.00'
-                # Monto USD column (column G)
-                if row[6].value and isinstance(row[6].value, (int, float)):
-                    row[6].number_format = '#,##0.00'
-                # FX Rate column (column H)
-                if row[7].value and isinstance(row[7].value, (int, float)):
-                    row[7].number_format = '0.00'
+        # Write-only mode streams rows out instead of building a cell grid, so
+        # column widths are worked out from the data before any row is written
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Gastos')
+        
+        # Auto-adjust column widths
+        for index, column in enumerate(column_order):
+            max_length = max([len(column)] + [len(str(row[index])) for row in rows if row[index] is not None])
+            adjusted_width = min(max_length + 2, 50)
+            worksheet.column_dimensions[get_column_letter(index + 1)].width = adjusted_width
+        
+        # Header formatting, registered once as a named style
+        header_style = NamedStyle(name='header')
+        header_style.fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+        header_style.font = Font(color="FFFFFF", bold=True)
+        header_style.alignment = Alignment(horizontal="center")
+        workbook.add_named_style(header_style)
+        
+        header = []
+        for column in column_order:
+            cell = WriteOnlyCell(worksheet, value=column)
+            cell.style = 'header'
+            header.append(cell)
+        worksheet.append(header)
+        
+        # Number formatting for the Monto column
+        monto_index = column_order.index('Monto')
+        for row in rows:
+            row = list(row)
+            cell = WriteOnlyCell(worksheet, value=row[monto_index])
+            cell.number_format = '#,##0.00'
+            row[monto_index] = cell
+            worksheet.append(row)
+        
+        workbook.save(output_filename)
         
         return output_filename
     
     def generate_summary_stats(self):
         """Generate summary statistics for the report"""
-        receipts = [r for r in self.db.get_all_receipts() if r['reviewed']]
+        receipts = self.db.get_receipts_for_export()
         
         if not receipts:
             return None
@@ -124,6 +106,7 @@ class ExcelExpenseGenerator:
         cc_totals = {}
         total_mxn = 0
         total_usd = 0
+        fx_rate_sum = 0
         
         for receipt in receipts:
             # Calculate MXN amount
@@ -143,6 +126,7 @@ class ExcelExpenseGenerator:
             
             total_mxn += amount_mxn
             total_usd += receipt.get('total_amount', 0)
+            fx_rate_sum += receipt.get('fx_rate', 0)
         
         return {
             'total_receipts': len(receipts),
@@ -150,7 +134,7 @@ class ExcelExpenseGenerator:
             'total_usd': total_usd,
             'category_totals': category_totals,
             'cc_totals': cc_totals,
-            'avg_fx_rate': sum(r.get('fx_rate', 0) for r in receipts) / len(receipts) if receipts else 0
+            'avg_fx_rate': fx_rate_sum / len(receipts)
         }
 
 def main():
@@ -4,16 +4,111 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
-from PIL import Image as PILImage
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from PIL import Image as PILImage, ImageOps, ImageChops
+import io
 import os
+import hashlib
+import threading
 from datetime import datetime
 from app.database import ExpenseDatabase
+from generators.amounts import receipt_amount_usd
 import pypdfium2 as pdfium
-import tempfile
+
+# pdfium is not thread-safe, so renders are serialized across threads
+_PDFIUM_LOCK = threading.Lock()
 
 class ExpensePDFGenerator:
-    def __init__(self):
-        self.db = ExpenseDatabase()
+    # Table styles don't depend on the data, so they are built once and shared
+    TITLE_INFO_TABLE_STYLE = TableStyle([
+        ('ALIGN', (0,0), (-1,-1), 'LEFT'),
+        ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
+        ('FONTNAME', (1,0), (1,-1), 'Helvetica'),
+        ('FONTSIZE', (0,0), (-1,-1), 12),
+        ('BOTTOMPADDING', (0,0), (-1,-1), 8),
+    ])
+
+    EMPLOYEE_TABLE_STYLE = TableStyle([
+        ('ALIGN', (0,0), (-1,-1), 'LEFT'),
+        ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
+        ('FONTNAME', (1,0), (1,-1), 'Helvetica'),
+        ('FONTSIZE', (0,0), (-1,-1), 12),
+        ('BOTTOMPADDING', (0,0), (-1,-1), 12),
+    ])
+
+    # The summary is drawn as a header table, blocks of receipt rows and a total table
+    # stacked flush, since ReportLab slows down splitting one long table across pages
+    SUMMARY_HEADER_STYLE = TableStyle([
+        ('BACKGROUND', (0,0), (-1,-1), colors.darkblue),
+        ('TEXTCOLOR', (0,0), (-1,-1), colors.whitesmoke),
+        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+        ('FONTNAME', (0,0), (-1,-1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0,0), (-1,-1), 12),
+        ('GRID', (0,0), (-1,-1), 1, colors.black),
+        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+        ('WORDWRAP', (0,0), (-1,-1), True),
+    ])
+
+    SUMMARY_ROWS_STYLE = TableStyle([
+        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+        ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
+        ('FONTSIZE', (0,0), (-1,-1), 10),
+        ('ROWBACKGROUNDS', (0,0), (-1,-1), [colors.beige, colors.white]),
+        ('GRID', (0,0), (-1,-1), 1, colors.black),
+        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+        ('LEFTPADDING', (1,0), (1,-1), 6),  # Restaurant names left-aligned
+        ('ALIGN', (1,0), (1,-1), 'LEFT'),
+        ('ALIGN', (3,0), (3,-1), 'LEFT'),  # Receipt names left-aligned, like wrapped ones
+        ('WORDWRAP', (0,0), (-1,-1), True),  # Enable word wrapping for all cells
+    ])
+
+    SUMMARY_TOTAL_STYLE = TableStyle([
+        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+        ('FONTNAME', (0,-1), (-1,-1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0,-1), (-1,-1), 12),
+        ('BACKGROUND', (0,-1), (-1,-1), colors.lightgrey),
+        ('LINEABOVE', (0,-1), (-1,-1), 2, colors.black),
+        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+        ('WORDWRAP', (0,0), (-1,-1), True),
+    ])
+
+    SUMMARY_COLUMN_WIDTHS = [1*inch, 2.5*inch, 0.8*inch, 2.2*inch]
+    # Receipt rows per summary block; even, so the row colours alternate across blocks
+    SUMMARY_ROWS_PER_TABLE = 40
+
+    # Room for text in the summary table's receipt name column (width less default padding)
+    SUMMARY_NAME_TEXT_WIDTH = 2.2*inch - 12
+
+    RECEIPT_INFO_TABLE_STYLE = TableStyle([
+        ('ALIGN', (0,0), (-1,-1), 'LEFT'),
+        ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
+        ('FONTNAME', (1,0), (1,-1), 'Helvetica'),
+        ('FONTSIZE', (0,0), (-1,-1), 10),
+        ('BOTTOMPADDING', (0,0), (-1,-1), 6),
+    ])
+
+    # Resolution receipt images are downscaled to for the page they are drawn at
+    IMAGE_DPI = 200
+    # JPEG settings for the embedded images; 4:2:0 chroma is plenty for receipts
+    JPEG_QUALITY = 80
+    JPEG_SUBSAMPLING = 2
+    # Extensions uploads are accepted with that are never PDFs
+    IMAGE_SUFFIXES = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff'})
+    # Largest difference between colour channels that still counts as a black and white page
+    GRAYSCALE_TOLERANCE = 16
+
+    # Downscaled copies of receipt images, named after the image they came from
+    IMAGE_CACHE_DIR = 'data/pdf_images'
+
+    def __init__(self, db=None, image_cache_dir=IMAGE_CACHE_DIR, executor=None, color_mode='auto'):
+        self.db = db or ExpenseDatabase()
+        self.image_cache_dir = image_cache_dir
+        # How PDF receipts are rendered: 'rgb', 'gray', or 'auto' to make each page without colour gray
+        self.color_mode = color_mode
+        # Optional executor used to prepare receipt images concurrently
+        self.executor = executor
+        # Prepared page images per (path, mtime, size), reused when a file comes up again
+        self._resize_cache = {}
         self.styles = getSampleStyleSheet()
         
         # Custom styles
@@ -40,19 +135,24 @@ class ExpensePDFGenerator:
             fontSize=10,
             spaceAfter=6
         )
+        
+        # Label above the second and later pages of a multi-page PDF receipt
+        self.page_label_style = ParagraphStyle(
+            'PageLabel',
+            parent=self.normal_style,
+            spaceBefore=10,
+            spaceAfter=16
+        )
     
     def generate_expense_report(self, output_filename="expense_report.pdf", include_images=True):
-        """Generate a complete expense report PDF with receipt images"""
+        """Generate a complete expense report PDF with receipt images (to a path or a file-like object)"""
 
-        # Get all reviewed receipts
-        receipts = [r for r in self.db.get_all_receipts() if r['reviewed']]
+        # Get all reviewed receipts, sorted alphabetically by display_filename
+        receipts = self.db.get_receipts_for_export(order_by_name=True)
 
         if not receipts:
             raise ValueError("No reviewed receipts found. Please review receipts in the web interface first.")
 
-        # Sort receipts alphabetically by display_filename
-        receipts.sort(key=lambda r: (r.get('display_filename') or r['filename']).lower())
-
         # Create PDF document
         doc = SimpleDocTemplate(
             output_filename,
@@ -76,15 +176,6 @@ class ExpensePDFGenerator:
         # Build PDF
         doc.build(story)
         
-        # Clean up temporary files
-        if hasattr(self, '_temp_files'):
-            for temp_file in self._temp_files:
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass  # Don't fail if cleanup doesn't work
-            del self._temp_files
-        
         return output_filename
     
     def _add_title_page(self, story, receipts):
@@ -97,23 +188,18 @@ class ExpensePDFGenerator:
         # Report info
         total_amount = sum(r['total_amount'] or 0 for r in receipts)
         date_range = self._get_date_range(receipts)
+        generated_at = datetime.now()
         
         info_data = [
             ["Report Period:", date_range],
             ["Number of Receipts:", str(len(receipts))],
             ["Total Amount:", f"${total_amount:.2f}"],
-            ["Generated Date:", datetime.now().strftime("%B %d, %Y")],
-            ["Generated Time:", datetime.now().strftime("%I:%M %p")]
+            ["Generated Date:", generated_at.strftime("%B %d, %Y")],
+            ["Generated Time:", generated_at.strftime("%I:%M %p")]
         ]
         
         info_table = Table(info_data, colWidths=[2*inch, 3*inch])
-        info_table.setStyle(TableStyle([
-            ('ALIGN', (0,0), (-1,-1), 'LEFT'),
-            ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
-            ('FONTNAME', (1,0), (1,-1), 'Helvetica'),
-            ('FONTSIZE', (0,0), (-1,-1), 12),
-            ('BOTTOMPADDING', (0,0), (-1,-1), 8),
-        ]))
+        info_table.setStyle(self.TITLE_INFO_TABLE_STYLE)
         
         story.append(info_table)
         story.append(Spacer(1, 30))
@@ -130,13 +216,7 @@ class ExpensePDFGenerator:
         ]
         
         employee_table = Table(employee_data, colWidths=[2*inch, 4*inch])
-        employee_table.setStyle(TableStyle([
-            ('ALIGN', (0,0), (-1,-1), 'LEFT'),
-            ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
-            ('FONTNAME', (1,0), (1,-1), 'Helvetica'),
-            ('FONTSIZE', (0,0), (-1,-1), 12),
-            ('BOTTOMPADDING', (0,0), (-1,-1), 12),
-        ]))
+        employee_table.setStyle(self.EMPLOYEE_TABLE_STYLE)
         
         story.append(employee_table)
         story.append(PageBreak())
@@ -150,73 +230,41 @@ class ExpensePDFGenerator:
         story.append(Spacer(1, 12))
 
         # Table headers
-        data = [["Date", "Restaurant/Venue", "Amount", "Receipt Name"]]
+        header = ["Date", "Restaurant/Venue", "Amount", "Receipt Name"]
+        data = []
 
-        # Add receipt data
+        # Add receipt data, accumulating the total as we go
+        total_amount_usd = 0
         for receipt in receipts:
             # Calculate USD amount
-            amount_usd = receipt.get('amount_mxn')  # This field stores USD amount
-            if not amount_usd and receipt.get('total_amount') and receipt.get('fx_rate'):
-                markup = receipt.get('markup_percent', 2.5)
-                usd_base = receipt['total_amount'] / receipt['fx_rate']
-                amount_usd = usd_base * (1 + markup / 100)
+            amount_usd = receipt_amount_usd(receipt)
+            total_amount_usd += amount_usd or 0
 
             # Use display_filename from database (set when receipt was reviewed)
             display_filename = receipt.get('display_filename') or receipt['filename']
 
-            # Create paragraph for filename to handle long names
-            filename_para = Paragraph(display_filename or 'N/A', self.normal_style)
+            # Only names too long for the column need a paragraph to wrap them
+            filename_cell = display_filename or 'N/A'
+            if stringWidth(filename_cell, self.normal_style.fontName,
+                           self.normal_style.fontSize) > self.SUMMARY_NAME_TEXT_WIDTH:
+                filename_cell = Paragraph(filename_cell, self.normal_style)
 
             data.append([
                 receipt['date'] or 'N/A',
                 receipt['restaurant_name'] or 'N/A',
                 f"${amount_usd:.2f}" if amount_usd else 'N/A',
-                filename_para
+                filename_cell
             ])
         
-        # Add total row
-        total_amount_usd = 0
-        for receipt in receipts:
-            amount_usd = receipt.get('amount_mxn')
-            if not amount_usd and receipt.get('total_amount') and receipt.get('fx_rate'):
-                markup = receipt.get('markup_percent', 2.5)
-                usd_base = receipt['total_amount'] / receipt['fx_rate']
-                amount_usd = usd_base * (1 + markup / 100)
-            total_amount_usd += amount_usd or 0
-        
-        data.append(['', '', '', ''])  # Empty row
-        data.append(['', 'TOTAL:', f"${total_amount_usd:.2f}", ''])
-        
-        # Create table with wider columns to prevent text overlap
-        table = Table(data, colWidths=[1*inch, 2.5*inch, 0.8*inch, 2.2*inch])
-        table.setStyle(TableStyle([
-            # Header row
-            ('BACKGROUND', (0,0), (-1,0), colors.darkblue),
-            ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
-            ('ALIGN', (0,0), (-1,-1), 'CENTER'),
-            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0,0), (-1,0), 12),
-            
-            # Data rows
-            ('FONTNAME', (0,1), (-1,-3), 'Helvetica'),
-            ('FONTSIZE', (0,1), (-1,-3), 10),
-            ('ROWBACKGROUNDS', (0,1), (-1,-3), [colors.beige, colors.white]),
-            
-            # Total row
-            ('FONTNAME', (0,-1), (-1,-1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0,-1), (-1,-1), 12),
-            ('BACKGROUND', (0,-1), (-1,-1), colors.lightgrey),
-            ('LINEABOVE', (0,-1), (-1,-1), 2, colors.black),
-            
-            # General formatting
-            ('GRID', (0,0), (-1,-3), 1, colors.black),
-            ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-            ('LEFTPADDING', (1,1), (1,-3), 6),  # Restaurant names left-aligned
-            ('ALIGN', (1,1), (1,-3), 'LEFT'),
-            ('WORDWRAP', (0,0), (-1,-1), True),  # Enable word wrapping for all cells
-        ]))
+        # Create tables with wider columns to prevent text overlap
+        story.append(Table([header], colWidths=self.SUMMARY_COLUMN_WIDTHS, style=self.SUMMARY_HEADER_STYLE))
+        for start in range(0, len(data), self.SUMMARY_ROWS_PER_TABLE):
+            story.append(Table(data[start:start + self.SUMMARY_ROWS_PER_TABLE],
+                               colWidths=self.SUMMARY_COLUMN_WIDTHS, style=self.SUMMARY_ROWS_STYLE))
         
-        story.append(table)
+        # Add total row after an empty one
+        total_rows = [['', '', '', ''], ['', 'TOTAL:', f"${total_amount_usd:.2f}", '']]
+        story.append(Table(total_rows, colWidths=self.SUMMARY_COLUMN_WIDTHS, style=self.SUMMARY_TOTAL_STYLE))
         return story
     
     def _add_receipt_details(self, story, receipts):
@@ -225,17 +273,15 @@ class ExpensePDFGenerator:
         story.append(Paragraph("RECEIPT DETAILS", self.title_style))
         story.append(Spacer(1, 20))
         
+        existing_paths = self._existing_file_paths(receipts)
+        
         for i, receipt in enumerate(receipts, 1):
             # Receipt header
             story.append(Paragraph(f"Receipt #{i:03d}", self.header_style))
             
             # Receipt info table
             # Calculate USD amount
-            amount_usd = receipt.get('amount_mxn')  # This field stores USD amount
-            if not amount_usd and receipt.get('total_amount') and receipt.get('fx_rate'):
-                markup = receipt.get('markup_percent', 2.5)
-                usd_base = receipt['total_amount'] / receipt['fx_rate']
-                amount_usd = usd_base * (1 + markup / 100)
+            amount_usd = receipt_amount_usd(receipt)
             
             info_data = [
                 ["Restaurant:", receipt['restaurant_name'] or 'N/A'],
@@ -245,19 +291,13 @@ class ExpensePDFGenerator:
             ]
             
             info_table = Table(info_data, colWidths=[1.5*inch, 4*inch])
-            info_table.setStyle(TableStyle([
-                ('ALIGN', (0,0), (-1,-1), 'LEFT'),
-                ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
-                ('FONTNAME', (1,0), (1,-1), 'Helvetica'),
-                ('FONTSIZE', (0,0), (-1,-1), 10),
-                ('BOTTOMPADDING', (0,0), (-1,-1), 6),
-            ]))
+            info_table.setStyle(self.RECEIPT_INFO_TABLE_STYLE)
             
             story.append(info_table)
             story.append(Spacer(1, 15))
 
             # Add receipt image(s) if file exists
-            if os.path.exists(receipt['file_path']):
+            if receipt['file_path'] in existing_paths:
                 try:
                     # Resize image(s) to fit page - returns list (multiple for PDFs, single for images)
                     images = self._resize_image_for_pdf(receipt['file_path'])
@@ -299,16 +339,23 @@ class ExpensePDFGenerator:
         seen_file_paths = set()
         unique_receipts = []
 
+        existing_paths = self._existing_file_paths(receipts)
+
         for receipt in receipts:
             file_path = receipt['file_path']
 
             # Only add if we haven't seen this file path before AND the file exists
             if (file_path and
                 file_path not in seen_file_paths and
-                os.path.exists(file_path)):
+                file_path in existing_paths):
                 seen_file_paths.add(file_path)
                 unique_receipts.append(receipt)
         
+        # Prepare every receipt's page images up front, in parallel, so the loop below
+        # only picks them up from the resize cache. pdfium renders still take turns.
+        if self.executor is not None:
+            list(self.executor.map(self._resize_image_for_pdf, [r['file_path'] for r in unique_receipts]))
+        
         for i, receipt in enumerate(unique_receipts, 1):
             # Use display_filename from database (set when receipt was reviewed)
             display_filename = receipt.get('display_filename') or receipt['filename']
@@ -323,42 +370,29 @@ class ExpensePDFGenerator:
             ]
             
             info_table = Table(info_data, colWidths=[1.5*inch, 4*inch])
-            info_table.setStyle(TableStyle([
-                ('ALIGN', (0,0), (-1,-1), 'LEFT'),
-                ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
-                ('FONTNAME', (1,0), (1,-1), 'Helvetica'),
-                ('FONTSIZE', (0,0), (-1,-1), 10),
-                ('BOTTOMPADDING', (0,0), (-1,-1), 6),
-            ]))
+            info_table.setStyle(self.RECEIPT_INFO_TABLE_STYLE)
             
             story.append(info_table)
             story.append(Spacer(1, 15))
 
-            # Add receipt image(s) if file exists
-            if os.path.exists(receipt['file_path']):
-                try:
-                    # Resize image(s) to fit page - returns list (multiple for PDFs, single for images)
-                    images = self._resize_image_for_pdf(receipt['file_path'])
-
-                    if images:
-                        # Add all images/pages
-                        for page_num, img in enumerate(images):
-                            if page_num > 0:
-                                # Add page label for multi-page PDFs
-                                story.append(Spacer(1, 10))
-                                story.append(Paragraph(f"Page {page_num + 1}", self.normal_style))
-                                story.append(Spacer(1, 10))
-                            story.append(img)
-
-                            # Add page break between pages of same receipt (except last page)
-                            if page_num < len(images) - 1:
-                                story.append(PageBreak())
-                    else:
-                        story.append(Paragraph("[Image could not be loaded]", self.normal_style))
-                except Exception as e:
-                    story.append(Paragraph(f"[Image could not be loaded: {str(e)}]", self.normal_style))
-            else:
-                story.append(Paragraph("[Receipt image not found]", self.normal_style))
+            # Add receipt image(s) - the file was checked when picking unique receipts,
+            # and one removed since then is reported as not loaded
+            try:
+                # Resize image(s) to fit page - returns list (multiple for PDFs, single for images)
+                images = self._resize_image_for_pdf(receipt['file_path'])
+
+                if images:
+                    # Add all images/pages
+                    for page_num, img in enumerate(images):
+                        if page_num > 0:
+                            # Start each further page of a multi-page PDF on its own page, with a label
+                            story.append(PageBreak())
+                            story.append(Paragraph(f"Page {page_num + 1}", self.page_label_style))
+                        story.append(img)
+                else:
+                    story.append(Paragraph("[Image could not be loaded]", self.normal_style))
+            except Exception as e:
+                story.append(Paragraph(f"[Image could not be loaded: {str(e)}]", self.normal_style))
 
             # Add page break between receipts (except for the last one)
             if i < len(unique_receipts):
@@ -366,29 +400,68 @@ class ExpensePDFGenerator:
         
         return story
     
-    def _convert_pdf_to_images(self, pdf_path):
-        """Convert all pages of a PDF to PIL Images"""
-        pil_images = []
-        temp_files = []
-
-        try:
-            pdf = pdfium.PdfDocument(pdf_path)
+    def _existing_file_paths(self, receipts):
+        """Get the receipt file paths that exist, listing each receipt folder once instead of checking every file"""
+        paths_by_folder = {}
+        for receipt in receipts:
+            if receipt['file_path']:
+                paths_by_folder.setdefault(os.path.dirname(receipt['file_path']), set()).add(receipt['file_path'])
 
-            for page_num in range(len(pdf)):
-                page = pdf[page_num]
-                # Render at 2x resolution for better quality
-                bitmap = page.render(scale=2.0)
-                pil_img = bitmap.to_pil()
-                pil_images.append(pil_img)
+        existing_paths = set()
+        for folder, paths in paths_by_folder.items():
+            try:
+                with os.scandir(folder or '.') as entries:
+                    names = {entry.name for entry in entries if entry.is_file()}
+            except OSError:
+                continue
+            existing_paths.update(path for path in paths if os.path.basename(path) in names)
+        return existing_paths
 
-        except Exception as e:
-            print(f"Error converting PDF {pdf_path}: {e}")
-            return []
+    def _iter_pdf_pages(self, pdf_path, max_width=5*inch, max_height=6*inch):
+        """Render the pages of a PDF one at a time as PIL Images, at about the size they will be placed at"""
+        target_width = max_width / inch * self.IMAGE_DPI
+        target_height = max_height / inch * self.IMAGE_DPI
+        grayscale = self.color_mode == 'gray'
 
-        return pil_images
+        # The lock is taken per pdfium call, so other threads can render while a page is encoded
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_path)
+            page_count = len(pdf)
+        try:
+            for page_num in range(page_count):
+                with _PDFIUM_LOCK:
+                    page = pdf[page_num]
+                    # Render straight at the target resolution instead of rendering large and shrinking
+                    scale = min(target_width / page.get_width(), target_height / page.get_height())
+                    # RGBX pixels let PIL wrap the bitmap's buffer instead of converting a BGR copy
+                    bitmap = page.render(scale=max(1.0, min(scale, 3.0)), grayscale=grayscale,
+                                         rev_byteorder=True, prefer_bgrx=True)
+                    pil_img = bitmap.to_pil()
+                    bitmap.close()
+                    page.close()
+                if self.color_mode == 'auto' and self._is_grayscale(pil_img):
+                    # Each page is checked on its own, so a colour page after a black and white one keeps its colour
+                    pil_img = pil_img.convert('L')
+                yield pil_img
+        finally:
+            with _PDFIUM_LOCK:
+                pdf.close()
+
+    def _is_grayscale(self, pil_img):
+        """Check if a rendered page has no visible colour, comparing its channels on a small copy"""
+        sample = pil_img.convert('RGB')
+        sample.thumbnail((256, 256))
+        red, green, blue = sample.split()
+        return max(ImageChops.difference(red, green).getextrema()[1],
+                   ImageChops.difference(green, blue).getextrema()[1]) <= self.GRAYSCALE_TOLERANCE
 
     def _is_pdf_file(self, file_path):
-        """Check if file is actually a PDF by reading its header"""
+        """Check if file is a PDF from its extension, reading its header only when the extension doesn't tell"""
+        suffix = os.path.splitext(file_path)[1].lower()
+        if suffix == '.pdf':
+            return True
+        if suffix in self.IMAGE_SUFFIXES:
+            return False
         try:
             with open(file_path, 'rb') as f:
                 header = f.read(4)
@@ -400,103 +473,157 @@ class ExpensePDFGenerator:
         """Resize image to fit in PDF while maintaining aspect ratio and fixing orientation
         Returns a list of ReportLab Image objects (list will have multiple items for multi-page PDFs)"""
 
-        images_to_process = []
+        try:
+            key = (image_path, os.path.getmtime(image_path), max_width, max_height)
+        except OSError:
+            key = None
+        if key in self._resize_cache:
+            # Build fresh flowables over the prepared sources; rendered pages are kept as bytes
+            return [Image(io.BytesIO(source) if isinstance(source, bytes) else source, width=width, height=height)
+                    for source, width, height in self._resize_cache[key]]
 
         # Check if this is a PDF file (by content, not just extension)
         if self._is_pdf_file(image_path):
-            # Convert PDF pages to PIL images
-            pil_images = self._convert_pdf_to_images(image_path)
-            if not pil_images:
-                return []
-            images_to_process = [(pil_img, True) for pil_img in pil_images]  # (image, needs_temp_file)
+            # Render PDF pages lazily, so each one is encoded and freed before the next
+            images_to_process = ((pil_img, True) for pil_img in   # (image, is_pil_image)
+                                 self._iter_pdf_pages(image_path, max_width, max_height))
         else:
-            # Handle regular image files
-            try:
-                with PILImage.open(image_path) as pil_img:
-                    # Check if image needs rotation based on EXIF orientation
-                    needs_rotation = False
-                    try:
-                        exif = pil_img._getexif()
-                        if exif is not None:
-                            orientation = exif.get(274)  # 274 is the EXIF orientation tag
-                            if orientation and orientation > 1:
-                                needs_rotation = True
-                                if orientation == 3:
-                                    pil_img = pil_img.rotate(180, expand=True)
-                                elif orientation == 6:
-                                    pil_img = pil_img.rotate(270, expand=True)
-                                elif orientation == 8:
-                                    pil_img = pil_img.rotate(90, expand=True)
-                    except:
-                        # If EXIF processing fails, continue with original image
-                        pass
-
-                    if needs_rotation:
-                        images_to_process = [(pil_img.copy(), True)]
-                    else:
-                        images_to_process = [(image_path, False)]  # Use original file path
-            except Exception as e:
-                print(f"Error opening image {image_path}: {e}")
+            # Handle regular image files through the on-disk cache
+            cached_path = self._get_cached_image(image_path, max_width, max_height)
+            if not cached_path:
                 return []
+            images_to_process = [(cached_path, False)]
 
         # Process all images (single image or multiple PDF pages)
         result_images = []
+        prepared = []
+        complete = True
 
-        for img_data, needs_temp_file in images_to_process:
-            try:
-                # Get image dimensions
-                if needs_temp_file:
-                    # It's a PIL Image object
-                    pil_img = img_data
-                    orig_width, orig_height = pil_img.size
-
-                    # Save to temp file
-                    temp_path = tempfile.mktemp(suffix='.jpg')
-                    pil_img.save(temp_path, 'JPEG', quality=85)
-                    use_temp_file = True
-                else:
-                    # It's a file path
-                    with PILImage.open(img_data) as pil_img:
+        try:
+            for img_data, is_pil_image in images_to_process:
+                try:
+                    # Get image dimensions
+                    if is_pil_image:
+                        # It's a rendered PDF page: downscale it to the page size and
+                        # keep the JPEG in memory rather than in a temp file
+                        pil_img = img_data
+                        pil_img.thumbnail((round(max_width / inch * self.IMAGE_DPI),
+                                           round(max_height / inch * self.IMAGE_DPI)), PILImage.LANCZOS)
+                        if pil_img.mode not in ('RGB', 'RGBX', 'L'):
+                            pil_img = pil_img.convert('RGB')
                         orig_width, orig_height = pil_img.size
-                    temp_path = img_data
-                    use_temp_file = False
 
-                # Calculate scaling factor
-                width_ratio = max_width / orig_width
-                height_ratio = max_height / orig_height
-                scale_factor = min(width_ratio, height_ratio)
+                        buffer = io.BytesIO()
+                        pil_img.save(buffer, 'JPEG', quality=self.JPEG_QUALITY, subsampling=self.JPEG_SUBSAMPLING)
+                        source = buffer.getvalue()
+                    else:
+                        # It's a file path
+                        with PILImage.open(img_data) as pil_img:
+                            orig_width, orig_height = pil_img.size
+                        source = img_data
 
-                # Calculate new dimensions
-                new_width = orig_width * scale_factor
-                new_height = orig_height * scale_factor
+                    # Calculate scaling factor
+                    width_ratio = max_width / orig_width
+                    height_ratio = max_height / orig_height
+                    scale_factor = min(width_ratio, height_ratio)
 
-                # Create ReportLab Image object
-                img = Image(temp_path, width=new_width, height=new_height)
-                result_images.append(img)
+                    # Calculate new dimensions
+                    new_width = orig_width * scale_factor
+                    new_height = orig_height * scale_factor
 
-                # Store temp file path for cleanup after PDF is built
-                if use_temp_file:
-                    if not hasattr(self, '_temp_files'):
-                        self._temp_files = []
-                    self._temp_files.append(temp_path)
+                    # Create ReportLab Image object
+                    img = Image(io.BytesIO(source) if is_pil_image else source, width=new_width, height=new_height)
+                    result_images.append(img)
+                    prepared.append((source, new_width, new_height))
 
-            except Exception as e:
-                print(f"Error processing image: {e}")
-                continue
+                except Exception as e:
+                    print(f"Error processing image: {e}")
+                    complete = False
+                    continue
+        except Exception as e:
+            # Opening or rendering the PDF failed; leave the receipt out rather than show some of its pages
+            print(f"Error converting PDF {image_path}: {e}")
+            return []
 
+        if key is not None and prepared and complete:
+            self._resize_cache[key] = prepared
         return result_images
     
+    def _get_cached_image(self, image_path, max_width=5*inch, max_height=6*inch):
+        """Get an upright copy of an image downscaled for the page, cached on disk by path and modification time
+        (small upright JPEGs are used as they are)"""
+        max_size = (round(max_width / inch * self.IMAGE_DPI), round(max_height / inch * self.IMAGE_DPI))
+        try:
+            stat = os.stat(image_path)
+            key = hashlib.blake2b(
+                f"{stat.st_mtime_ns}:{stat.st_size}:{max_size}:{self.JPEG_QUALITY}:{self.JPEG_SUBSAMPLING}".encode(),
+                digest_size=8).hexdigest()
+            cached_path = os.path.join(self.image_cache_dir, f"{self._image_cache_prefix(image_path)}{key}.jpg")
+            if os.path.exists(cached_path):
+                return cached_path
+
+            with PILImage.open(image_path) as pil_img:
+                # A JPEG that already fits and needs no rotation would only lose quality being re-encoded
+                if (pil_img.format == 'JPEG' and pil_img.mode in ('RGB', 'L') and
+                        pil_img.width <= max_size[0] and pil_img.height <= max_size[1] and
+                        pil_img.getexif().get(0x0112, 1) == 1):
+                    return image_path
+
+                # Let the JPEG decoder downscale while loading; either side may end up
+                # as the width once the EXIF orientation is applied
+                pil_img.draft('RGB', (max(max_size), max(max_size)))
+                pil_img = ImageOps.exif_transpose(pil_img)
+                if pil_img.mode not in ('RGB', 'L'):
+                    # Flatten any transparency onto white
+                    pil_img = pil_img.convert('RGBA')
+                    background = PILImage.new('RGB', pil_img.size, (255, 255, 255))
+                    background.paste(pil_img, mask=pil_img.getchannel('A'))
+                    pil_img = background
+                pil_img.thumbnail(max_size, PILImage.LANCZOS)
+
+                # Write under a temporary name so a concurrent build never reads a partial file
+                os.makedirs(self.image_cache_dir, exist_ok=True)
+                temp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                # Cached files are encoded once, so they can afford the extra optimize pass
+                pil_img.save(temp_path, 'JPEG', quality=self.JPEG_QUALITY, subsampling=self.JPEG_SUBSAMPLING,
+                             optimize=True, progressive=True)
+            os.replace(temp_path, cached_path)
+            return cached_path
+
+        except Exception as e:
+            print(f"Error opening image {image_path}: {e}")
+            return None
+    
+    @staticmethod
+    def _image_cache_prefix(image_path):
+        """Get the file name prefix shared by every cached copy of an image"""
+        return hashlib.blake2b(os.path.abspath(image_path).encode(), digest_size=8).hexdigest() + '_'
+
+    @classmethod
+    def purge_cached_images(cls, image_path, image_cache_dir=IMAGE_CACHE_DIR):
+        """Delete every cached copy of an image, e.g. once its receipt is deleted"""
+        prefix = cls._image_cache_prefix(image_path)
+        try:
+            entries = list(os.scandir(image_cache_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.name.startswith(prefix):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
     def _get_date_range(self, receipts):
         """Get date range from receipts"""
         dates = [r['date'] for r in receipts if r['date']]
         if not dates:
             return "N/A"
         
-        dates.sort()
         if len(dates) == 1:
             return dates[0]
         else:
-            return f"{dates[0]} to {dates[-1]}"
+            return f"{min(dates)} to {max(dates)}"
 
 def main():
     """Test PDF generation"""
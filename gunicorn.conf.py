@@ -0,0 +1,17 @@
+"""
+Gunicorn settings for serving the Expense Reader web app: gunicorn app.main:app
+"""
+import os
+
+bind = '127.0.0.1:8080'
+
+# Threaded workers - requests mostly wait on SQLite, the disk, or OpenAI, so
+# a couple of processes are enough. Each worker shares the OCR and OpenAI
+# pools out by this count (see app/main.py), so the totals stay the same.
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = 'gthread'
+threads = 4
+
+# OCR and report generation can take a while for large uploads
+timeout = 120
@@ -18,11 +18,14 @@ sys.path.insert(0, current_dir)
 
 # Import our Flask app
 from app import app
+from waitress.server import create_server
 
 class ExpenseReaderApp:
     def __init__(self):
         self.flask_thread = None
         self.server_running = False
+        # Set by run_flask once the port is bound, or once starting it has failed
+        self.server_ready = threading.Event()
         self.port = 8080
         
     def start_server(self):
@@ -31,35 +34,49 @@ class ExpenseReaderApp:
             print("🧾 Starting Expense Reader Desktop App...")
             print("📂 Launching server...")
             
-            # Start Flask in a separate thread
+            # Start Flask in a separate thread (it clears the flag if it fails)
+            self.server_running = True
             self.flask_thread = threading.Thread(target=self.run_flask, daemon=True)
             self.flask_thread.start()
             
             # Wait for server to start
-            time.sleep(3)
+            if not self.wait_for_server():
+                print(f"❌ Server did not start on port {self.port}")
+                self.server_running = False
+                return False
             
-            if self.server_running:
-                print(f"✅ Server running at http://127.0.0.1:{self.port}")
-                print("🌐 Opening browser...")
-                self.open_browser()
-                print("\n" + "="*50)
-                print("📊 EXPENSE READER IS NOW RUNNING")
-                print("="*50)
-                print(f"🔗 Web Interface: http://127.0.0.1:{self.port}")
-                print("📱 Use your browser to upload and process receipts")
-                print("🛑 Press Ctrl+C to stop the server")
-                print("="*50)
-                print("\nServer output:")
+            print(f"✅ Server running at http://127.0.0.1:{self.port}")
+            print("🌐 Opening browser...")
+            self.open_browser()
+            print("\n" + "="*50)
+            print("📊 EXPENSE READER IS NOW RUNNING")
+            print("="*50)
+            print(f"🔗 Web Interface: http://127.0.0.1:{self.port}")
+            print("📱 Use your browser to upload and process receipts")
+            print("🛑 Press Ctrl+C to stop the server")
+            print("="*50)
+            print("\nServer output:")
+        return self.server_running
+    
+    def wait_for_server(self, timeout=10):
+        """Wait until this app's server has bound its port, returning False if it failed or timed out"""
+        # A connection test could be answered by another program already on the port
+        return self.server_ready.wait(timeout) and self.server_running
     
     def run_flask(self):
         """Run the Flask application"""
         try:
             self.server_running = True
-            # Configure Flask to run without debug mode for production
-            app.run(host='127.0.0.1', port=self.port, debug=False, use_reloader=False)
+            # Serve with waitress rather than the development server, so an upload
+            # being processed doesn't hold up the rest of the interface.
+            # Creating the server binds the port, so readiness is known before it runs.
+            server = create_server(app, host='127.0.0.1', port=self.port, threads=8)
+            self.server_ready.set()
+            server.run()
         except Exception as e:
             print(f"❌ Flask server error: {e}")
             self.server_running = False
+            self.server_ready.set()
     
     def open_browser(self):
         """Open the web interface in default browser"""
@@ -72,7 +89,8 @@ class ExpenseReaderApp:
     def run(self):
         """Start the desktop application"""
         try:
-            self.start_server()
+            if not self.start_server():
+                return
             
             # Keep the main thread alive
             while True:
@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 import os
 import sys
-from expense_reader import ExpenseReader
-from database import ExpenseDatabase
+from concurrent.futures import ThreadPoolExecutor
 
-def process_receipts_to_database(folder_path):
-    """Process receipts and store in database for web interface"""
+# The app's packages live in the project root, one level above scripts/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def process_receipts_to_database(folder_path, force=False):
+    """Process receipts and store in database for web interface, skipping ones already stored unless forced"""
     if not os.path.exists(folder_path):
         print(f"Error: Folder '{folder_path}' does not exist")
         return
@@ -16,63 +18,86 @@ def process_receipts_to_database(folder_path):
     
     print(f"Processing all receipt images in: {folder_path}")
     
+    # Imported here so usage and folder errors don't wait for OpenAI, Tesseract and pandas to load
+    from core.expense_reader import ExpenseReader
+    from app.database import ExpenseDatabase
+    
     # Initialize components
     reader = ExpenseReader()
     db = ExpenseDatabase()
     
     # Get list of image files
-    image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
-    image_files = []
-    
-    for filename in os.listdir(folder_path):
-        if any(filename.lower().endswith(ext) for ext in image_extensions):
-            image_files.append(filename)
+    image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff')
+    with os.scandir(folder_path) as entries:
+        image_entries = [entry for entry in entries
+                         if entry.name.lower().endswith(image_extensions) and entry.is_file()]
     
-    if not image_files:
+    if not image_entries:
         print("No image files found in the specified folder")
         return
     
-    processed_count = 0
+    # Receipts already in the database would only cost another OCR and OpenAI round
+    if not force:
+        # Compare absolute paths, so the same folder given relatively or absolutely still matches
+        existing_paths = {os.path.abspath(path) for path in db.get_receipt_file_paths() if path}
+        new_entries = [entry for entry in image_entries if os.path.abspath(entry.path) not in existing_paths]
+        if len(new_entries) < len(image_entries):
+            print(f"Skipping {len(image_entries) - len(new_entries)} receipts already in the database "
+                  f"(use --force to redo them)")
+        image_entries = new_entries
+        if not image_entries:
+            print("No new receipts to process")
+            return
     
-    for filename in image_files:
-        image_path = os.path.join(folder_path, filename)
-        print(f"Processing: {filename}")
-        
-        # Extract text using OCR
-        ocr_text = reader.extract_text_from_image(image_path)
+    image_files = [entry.name for entry in image_entries]
+    image_paths = [entry.path for entry in image_entries]
+    print(f"Extracting {len(image_paths)} receipts...")
+    
+    # OCR runs in parallel, then the texts go to OpenAI in batches; the
+    # results are saved from this thread, in folder listing order
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        ocr_texts = reader.extract_text_from_files(image_paths, executor=executor)
+        receipt_data_list = reader.extract_receipt_data_batch(ocr_texts, executor=executor)
+    
+    receipts = []
+    
+    for filename, image_path, ocr_text, receipt_data in zip(image_files, image_paths, ocr_texts, receipt_data_list):
         if not ocr_text:
             print(f"  Failed to extract text from {filename}")
             continue
         
-        # Extract structured data using OpenAI
-        receipt_data = reader.extract_receipt_data(ocr_text)
-        
-        # Save to database
-        receipt_id = db.add_receipt(
+        receipts.append(dict(
             filename=filename,
             file_path=image_path,
             ocr_text=ocr_text,
             restaurant_name=receipt_data.get('restaurant_name') if receipt_data else None,
             date=receipt_data.get('date') if receipt_data else None,
             total_amount=receipt_data.get('total_amount') if receipt_data else None
-        )
-        
-        print(f"  Saved to database with ID: {receipt_id}")
-        processed_count += 1
+        ))
     
-    print(f"\nSuccessfully processed {processed_count} receipts")
+    # Save to database in a single transaction
+    receipt_ids = db.add_receipts(receipts)
+    for receipt, receipt_id in zip(receipts, receipt_ids):
+        print(f"  Saved {receipt['filename']} to database with ID: {receipt_id}")
+    
+    print(f"\nSuccessfully processed {len(receipt_ids)} receipts")
     print("You can now review and edit them using the web interface:")
     print("Run: python app.py")
     print("Then open: http://localhost:5000")
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python web_batch_process.py <folder_path>")
+    args = sys.argv[1:]
+    force = '--force' in args
+    if force:
+        args.remove('--force')
+    
+    if len(args) != 1:
+        print("Usage: python web_batch_process.py [--force] <folder_path>")
         print("Example: python web_batch_process.py ./receipts")
         sys.exit(1)
     
-    folder_path = sys.argv[1]
-    process_receipts_to_database(folder_path)
+    folder_path = args[0]
+    process_receipts_to_database(folder_path, force=force)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file